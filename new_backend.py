@@ -1,19 +1,44 @@
 import os
-import io
+import uuid
+import asyncio
+import base64
+import gzip
+import tempfile
+import multiprocessing
+import json
 import time
+import queue
+import hashlib
+import heapq
+import sqlite3
+import unicodedata
+import re
+import zlib
+import fcntl
 import threading
 import logging
-from typing import List, Optional
+import math
+import mmap
+from contextlib import asynccontextmanager, contextmanager
+from datetime import datetime, timezone
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from collections import OrderedDict, deque
+from urllib.parse import urlparse
+from typing import Callable, Dict, List, Optional, Tuple
 
-import torch
-from fastapi import FastAPI, UploadFile, File, BackgroundTasks
-from fastapi.responses import HTMLResponse, RedirectResponse
+import numpy as np
+from fastapi import APIRouter, FastAPI, UploadFile, File, BackgroundTasks, HTTPException
+from fastapi.routing import APIRoute
+from fastapi.responses import HTMLResponse, RedirectResponse, StreamingResponse
 from pydantic import BaseModel
 import requests
-import google.generativeai as genai
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import soundfile as sf
 from dotenv import load_dotenv
 
+import transcribe_worker
+
 # -----------------------------------------------------
 # LOAD ENV
 # -----------------------------------------------------
@@ -26,6 +51,29 @@ DISCORD_CLIENT_SECRET = os.getenv("DISCORD_CLIENT_SECRET")
 DISCORD_REDIRECT_URI = os.getenv("DISCORD_REDIRECT_URI")
 DISCORD_BOT_TOKEN = os.getenv("DISCORD_BOT_TOKEN")
 
+# serve the I/O-bound routes with async handlers (async Gemini / httpx / supabase)
+ASYNC_IO = os.getenv("ASYNC_IO", "0").lower() in ("1", "true", "yes")
+
+GEMINI_MODEL = os.getenv("GEMINI_MODEL", "gemini-2.5-flash")
+GEMINI_BATCH_MAX_SIZE = int(os.getenv("GEMINI_BATCH_MAX_SIZE", "16"))
+GEMINI_BATCH_MAX_WAIT_MS = int(os.getenv("GEMINI_BATCH_MAX_WAIT_MS", "25"))
+GEMINI_BATCH_WORKERS = int(os.getenv("GEMINI_BATCH_WORKERS", "4"))
+GEMINI_EMBED_MODEL = os.getenv("GEMINI_EMBED_MODEL", "models/text-embedding-004")
+
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "10000"))
+CACHE_TTL_SECONDS = int(os.getenv("CACHE_TTL_SECONDS", str(7 * 24 * 3600)))
+CACHE_SQLITE_PATH = os.getenv("CACHE_SQLITE_PATH")  # optional on-disk tier
+CACHE_SQLITE_MAX_ENTRIES = int(os.getenv("CACHE_SQLITE_MAX_ENTRIES", "500000"))
+
+# when set, vector indexes live in memory-mapped files under this dir instead of RAM
+EMBED_STORE_DIR = os.getenv("EMBED_STORE_DIR")
+EMBED_STORE_DTYPE = os.getenv("EMBED_STORE_DTYPE", "float16")  # float32 | float16 | int8
+
+SYNC_UPSERT_CHUNK = int(os.getenv("SYNC_UPSERT_CHUNK", "500"))
+SYNC_UPSERT_RETRIES = int(os.getenv("SYNC_UPSERT_RETRIES", "3"))
+SYNC_UPSERT_BACKOFF = float(os.getenv("SYNC_UPSERT_BACKOFF", "0.5"))
+SYNC_MAX_PAGES = int(os.getenv("SYNC_MAX_PAGES", "50"))  # per channel per run; the rest waits for the next run
+
 SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_KEY = os.getenv("SUPABASE_SERVICE_ROLE_KEY") or os.getenv("SUPABASE_KEY")
 
@@ -33,39 +81,462 @@ SUPABASE_KEY = os.getenv("SUPABASE_SERVICE_ROLE_KEY") or os.getenv("SUPABASE_KEY
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("backend")
 
-# -----------------------------------------------------
-# CONFIGURE MODELS
-# -----------------------------------------------------
-try:
-    genai.configure(api_key=GEMINI_API_KEY)
-except Exception as e:
-    logger.warning("Could not configure Gemini: %s", e)
-
-# whisper (local)
-import whisper
-try:
-    whisper_model = whisper.load_model(WHISPER_MODEL)
-except Exception as e:
-    logger.warning("Whisper model load failed: %s", e)
-    whisper_model = None
-
 # -----------------------------------------------------
 # FASTAPI
 # -----------------------------------------------------
 app = FastAPI(title="MAX Intelligent System")
 
 # -----------------------------------------------------
-# SUPABASE CLIENT
+# COMPONENT REGISTRY (lazy clients / models)
 # -----------------------------------------------------
-from supabase import create_client, Client
-supabase: Optional[Client] = None
-if SUPABASE_URL and SUPABASE_KEY:
+WARMUP = [c.strip() for c in os.getenv("WARMUP", "").split(",") if c.strip()]  # e.g. "gemini_model,supabase,whisper"
+
+_NOT_LOADED = object()
+
+
+class Registry:
+    """Heavy clients and models, built on first use instead of at import.
+
+    Text-only workers never pay for Whisper, and nobody pays for the Gemini
+    SDK or the Supabase client until a route needs them. ``warmup`` loads
+    components up front (WARMUP on startup, or POST /warmup) and ``status``
+    feeds /ready.
+    """
+
+    def __init__(self):
+        self._loaders: Dict[str, Callable[[], object]] = {}
+        self._values: Dict[str, object] = {}
+        self._info: Dict[str, dict] = {}
+        # one lock per component: a slow load (e.g. a Whisper warmup) must not block the others
+        self._locks: Dict[str, threading.Lock] = {}
+
+    def register(self, name: str, loader: Callable[[], object]):
+        self._loaders[name] = loader
+        self._locks[name] = threading.Lock()
+
+    def get(self, name: str):
+        value = self._values.get(name, _NOT_LOADED)
+        if value is not _NOT_LOADED:
+            return value
+        with self._locks[name]:
+            value = self._values.get(name, _NOT_LOADED)
+            if value is _NOT_LOADED:
+                started = time.monotonic()
+                try:
+                    value = self._loaders[name]()
+                except Exception as e:
+                    self._info[name] = {"loaded": False, "error": str(e)}
+                    raise
+                self._values[name] = value
+                self._info[name] = {"loaded": True, "load_seconds": round(time.monotonic() - started, 3)}
+                logger.info("Loaded %s in %.2fs", name, self._info[name]["load_seconds"])
+            return value
+
+    def warmup(self, names: List[str]):
+        for name in names:
+            if name not in self._loaders:
+                logger.warning("Unknown warmup component: %s", name)
+                continue
+            try:
+                self.get(name)
+            except Exception as e:
+                logger.warning("Warmup of %s failed: %s", name, e)
+
+    def status(self) -> Dict[str, dict]:
+        return {name: dict(self._info.get(name, {"loaded": False})) for name in self._loaders}
+
+
+registry = Registry()
+
+
+class _Lazy:
+    """Module-level stand-in for a registry component; loads it on first use."""
+
+    def __init__(self, name: str):
+        self._name = name
+
+    def __getattr__(self, attr):
+        return getattr(registry.get(self._name), attr)
+
+    def __bool__(self):
+        return registry.get(self._name) is not None
+
+
+def _load_genai():
+    import google.generativeai as genai_sdk
     try:
-        supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
+        genai_sdk.configure(api_key=GEMINI_API_KEY)
+    except Exception as e:
+        logger.warning("Could not configure Gemini: %s", e)
+    return genai_sdk
+
+
+def _load_supabase():
+    if not (SUPABASE_URL and SUPABASE_KEY):
+        logger.warning("Supabase env not found; DB routes will error until configured")
+        return None
+    from supabase import create_client
+    try:
+        return create_client(SUPABASE_URL, SUPABASE_KEY)
     except Exception as e:
         logger.warning("Could not create supabase client: %s", e)
-else:
-    logger.warning("Supabase env not found; DB routes will error until configured")
+        return None
+
+
+registry.register("genai", _load_genai)
+# one shared model instance for every route (creating it per call is wasted work)
+registry.register("gemini_model", lambda: registry.get("genai").GenerativeModel(GEMINI_MODEL))
+registry.register("supabase", _load_supabase)
+
+genai = _Lazy("genai")
+gemini_model = _Lazy("gemini_model")
+supabase = _Lazy("supabase")
+
+
+@app.on_event("startup")
+def _start_warmup():
+    if WARMUP:
+        # in the background so the worker starts serving text routes immediately
+        threading.Thread(target=registry.warmup, args=(WARMUP,), name="warmup", daemon=True).start()
+
+
+@app.post("/warmup")
+def warmup(components: Optional[str] = None):
+    names = [c.strip() for c in components.split(",")] if components else list(registry.status())
+    registry.warmup(names)
+    return {"components": registry.status()}
+
+
+@app.get("/ready")
+def ready():
+    status = registry.status()
+    return {
+        "ready": all(status.get(name, {}).get("loaded") for name in WARMUP),
+        "components": status,
+    }
+
+# -----------------------------------------------------
+# HTTP CONNECTION POOL (all outbound requests)
+# -----------------------------------------------------
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "5"))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "30"))
+HTTP_POOL_DEFAULT_SIZE = int(os.getenv("HTTP_POOL_DEFAULT_SIZE", "10"))
+HTTP_CONNECT_RETRIES = int(os.getenv("HTTP_CONNECT_RETRIES", "2"))
+
+# keep-alive connections kept per host
+HTTP_POOL_SIZES = {
+    "discord.com": int(os.getenv("HTTP_POOL_DISCORD", "16")),
+    "api-inference.huggingface.co": int(os.getenv("HTTP_POOL_HF", "4")),
+}
+
+
+class HttpPool:
+    """One keep-alive requests.Session per host with a sized connection pool.
+
+    Every request gets a (connect, read) timeout unless the caller passes one.
+    Only connection failures are retried here (the request never left), so
+    non-idempotent POSTs stay safe; status-level retries belong to callers like
+    DiscordClient that understand the API. Sessions are created on first use
+    and closed with the app.
+    """
+
+    def __init__(self):
+        self._sessions: Dict[str, requests.Session] = {}
+        self._lock = threading.Lock()
+
+    def session(self, url: str) -> requests.Session:
+        host = urlparse(url).netloc
+        sess = self._sessions.get(host)
+        if sess is not None:
+            return sess
+        with self._lock:
+            sess = self._sessions.get(host)
+            if sess is None:
+                size = HTTP_POOL_SIZES.get(host, HTTP_POOL_DEFAULT_SIZE)
+                adapter = HTTPAdapter(
+                    pool_connections=1,
+                    pool_maxsize=size,
+                    max_retries=Retry(total=HTTP_CONNECT_RETRIES, connect=HTTP_CONNECT_RETRIES, read=0,
+                                      status=0, redirect=0, backoff_factor=0.3, raise_on_status=False),
+                )
+                sess = requests.Session()
+                sess.mount("https://", adapter)
+                sess.mount("http://", adapter)
+                self._sessions[host] = sess
+            return sess
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        kwargs.setdefault("timeout", (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT))
+        return self.session(url).request(method, url, **kwargs)
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        return self.request("POST", url, **kwargs)
+
+    def start(self):
+        for host in HTTP_POOL_SIZES:
+            self.session(f"https://{host}/")
+
+    def close(self):
+        with self._lock:
+            sessions, self._sessions = self._sessions, {}
+        for sess in sessions.values():
+            sess.close()
+
+    def stats(self) -> dict:
+        hosts = {}
+        for host, sess in list(self._sessions.items()):
+            opened = requests_made = 0
+            manager = sess.get_adapter("https://").poolmanager
+            for key in list(manager.pools.keys()):
+                pool = manager.pools.get(key)
+                if pool is None:
+                    continue
+                opened += pool.num_connections
+                requests_made += pool.num_requests
+            hosts[host] = {
+                "requests": requests_made,
+                "connections_opened": opened,
+                "connections_reused": max(0, requests_made - opened),
+                "pool_size": HTTP_POOL_SIZES.get(host, HTTP_POOL_DEFAULT_SIZE),
+            }
+        return {"hosts": hosts}
+
+
+http_pool = HttpPool()
+
+
+_async_http = None
+
+
+def async_http():
+    """Shared httpx.AsyncClient for the ASYNC_IO routes, created on first use."""
+    global _async_http
+    if _async_http is None:
+        import httpx
+        _async_http = httpx.AsyncClient(
+            timeout=httpx.Timeout(HTTP_READ_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+            limits=httpx.Limits(max_connections=sum(HTTP_POOL_SIZES.values()) + HTTP_POOL_DEFAULT_SIZE,
+                                max_keepalive_connections=max(HTTP_POOL_SIZES.values())),
+        )
+    return _async_http
+
+
+@app.on_event("startup")
+def _start_http_pool():
+    http_pool.start()
+
+
+@app.on_event("shutdown")
+async def _close_http_pool():
+    http_pool.close()
+    if _async_http is not None:
+        await _async_http.aclose()
+
+
+@app.get("/http/stats")
+def http_stats():
+    return http_pool.stats()
+
+# -----------------------------------------------------
+# WRITE-BEHIND (buffered Supabase inserts)
+# -----------------------------------------------------
+WRITE_BEHIND_QUEUE_SIZE = int(os.getenv("WRITE_BEHIND_QUEUE_SIZE", "10000"))
+WRITE_BEHIND_BATCH = int(os.getenv("WRITE_BEHIND_BATCH", "200"))
+WRITE_BEHIND_FLUSH_SECONDS = float(os.getenv("WRITE_BEHIND_FLUSH_SECONDS", "1.0"))
+WRITE_BEHIND_RETRIES = int(os.getenv("WRITE_BEHIND_RETRIES", "4"))
+WRITE_BEHIND_SPILL_DIR = os.getenv("WRITE_BEHIND_SPILL_DIR", os.path.join(tempfile.gettempdir(), "write_behind"))
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class WriteBehind:
+    """Buffered inserts for one table, so requests never wait on the database.
+
+    ``put`` only enqueues. A flusher thread writes batches of up to
+    WRITE_BEHIND_BATCH rows, or whatever has arrived after
+    WRITE_BEHIND_FLUSH_SECONDS, retrying with exponential backoff. Batches that
+    still fail, and rows that arrive while the queue is full, are appended to a
+    JSONL spill file that is replayed after the next successful write.
+    ``close`` drains the queue on shutdown.
+    """
+
+    def __init__(self, table: str):
+        self.table = table
+        self.spill_path = os.path.join(WRITE_BEHIND_SPILL_DIR, f"{table}.jsonl")
+        self._queue: "queue.Queue[dict]" = queue.Queue(maxsize=WRITE_BEHIND_QUEUE_SIZE)
+        self._lock = threading.Lock()
+        self._spill_lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._stopping = threading.Event()
+        self.stats = {"queued": 0, "written": 0, "spilled": 0, "replayed": 0, "failed_batches": 0}
+
+    def put(self, row: dict) -> bool:
+        """Queue a row; returns False if it had to go straight to the spill file."""
+        self._ensure_started()
+        try:
+            self._queue.put_nowait(row)
+            self.stats["queued"] += 1
+            return True
+        except queue.Full:
+            self._spill([row])
+            return False
+
+    def _ensure_started(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=f"write-behind-{self.table}", daemon=True)
+                self._thread.start()
+
+    def _next_batch(self) -> List[dict]:
+        try:
+            batch = [self._queue.get(timeout=WRITE_BEHIND_FLUSH_SECONDS)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + WRITE_BEHIND_FLUSH_SECONDS
+        while len(batch) < WRITE_BEHIND_BATCH:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while not self._stopping.is_set():
+            batch = self._next_batch()
+            if batch:
+                self._write(batch)
+
+    def _insert(self, rows: List[dict]):
+        supabase.table(self.table).insert(rows).execute()
+
+    def _write(self, batch: List[dict], retries: int = WRITE_BEHIND_RETRIES):
+        if not supabase:
+            logger.warning("Supabase not configured - dropping %d %s rows", len(batch), self.table)
+            return
+        for attempt in range(max(1, retries)):
+            try:
+                self._insert(batch)
+                self.stats["written"] += len(batch)
+                break
+            except Exception as e:
+                logger.warning("Write-behind insert into %s failed (attempt %d): %s", self.table, attempt + 1, e)
+                if attempt + 1 < retries and not self._stopping.is_set():
+                    time.sleep(min(30.0, 0.5 * (2 ** attempt)))
+        else:
+            self.stats["failed_batches"] += 1
+            self._spill(batch)
+            return
+        # outside the retry loop: a replay problem must not re-send the batch above
+        try:
+            self._replay_spill()
+        except Exception:
+            logger.exception("Spill replay for %s failed", self.table)
+
+    def _spill(self, rows: List[dict]):
+        with self._spill_lock:
+            os.makedirs(WRITE_BEHIND_SPILL_DIR, exist_ok=True)
+            with open(self.spill_path, "a") as f:
+                f.write("".join(json.dumps(row, default=str) + "\n" for row in rows))
+        self.stats["spilled"] += len(rows)
+        logger.warning("Spilled %d %s rows to %s", len(rows), self.table, self.spill_path)
+
+    def _claim_spill_files(self) -> List[str]:
+        """Move the spill file, plus files left by replayers that died, to names owned by this process."""
+        claimed = []
+        prefix = os.path.basename(self.spill_path) + "."
+        with self._spill_lock:
+            sources = [self.spill_path]
+            for name in os.listdir(WRITE_BEHIND_SPILL_DIR):
+                if name.startswith(prefix) and name.endswith(".replay"):
+                    pid = name[len(prefix):].split(".")[0]
+                    if pid.isdigit() and not _pid_alive(int(pid)):
+                        sources.append(os.path.join(WRITE_BEHIND_SPILL_DIR, name))
+            for src in sources:
+                # another worker may be replaying the same table; whoever renames first owns it
+                dst = f"{self.spill_path}.{os.getpid()}.{uuid.uuid4().hex}.replay"
+                try:
+                    os.replace(src, dst)
+                except FileNotFoundError:
+                    continue
+                claimed.append(dst)
+        return claimed
+
+    def _replay_spill(self):
+        """Re-insert spilled rows now that the database answers again."""
+        if not os.path.isdir(WRITE_BEHIND_SPILL_DIR):
+            return
+        for claimed in self._claim_spill_files():
+            rows, bad = [], []
+            with open(claimed) as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    try:
+                        rows.append(json.loads(line))
+                    except ValueError:
+                        # e.g. a line cut short by a crash mid-append
+                        bad.append(line if line.endswith("\n") else line + "\n")
+            if bad:
+                with self._spill_lock, open(self.spill_path + ".bad", "a") as f:
+                    f.write("".join(bad))
+                logger.warning("Quarantined %d unreadable %s spill lines in %s.bad", len(bad), self.table, self.spill_path)
+            for start in range(0, len(rows), WRITE_BEHIND_BATCH):
+                chunk = rows[start:start + WRITE_BEHIND_BATCH]
+                try:
+                    self._insert(chunk)
+                    self.stats["replayed"] += len(chunk)
+                except Exception as e:
+                    logger.warning("Spill replay for %s failed: %s", self.table, e)
+                    self._spill(rows[start:])
+                    break
+            # every row is now either in the table or back in the spill file
+            os.remove(claimed)
+
+    def close(self, timeout: float = 10.0):
+        """Stop the flusher and write out whatever is still queued."""
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        rows = []
+        while True:
+            try:
+                rows.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        for start in range(0, len(rows), WRITE_BEHIND_BATCH):
+            self._write(rows[start:start + WRITE_BEHIND_BATCH], retries=1)
+
+
+write_behind: Dict[str, WriteBehind] = {
+    table: WriteBehind(table) for table in ("messages", "audio_transcripts", "discord_events")
+}
+
+
+@app.on_event("shutdown")
+def _flush_write_behind():
+    for buffer in write_behind.values():
+        buffer.close()
+
+
+@app.get("/write_behind/stats")
+def write_behind_stats():
+    return {table: dict(buffer.stats, pending=buffer._queue.qsize()) for table, buffer in write_behind.items()}
 
 # -----------------------------------------------------
 # MODELS / SCHEMAS
@@ -73,14 +544,432 @@ else:
 class TextIn(BaseModel):
     text: str
 
+
+class TextsIn(BaseModel):
+    texts: List[str]
+
 # -----------------------------------------------------
-# SIMPLE GEMINI ROUTES
+# ADMISSION CONTROL + REQUEST COALESCING (per Gemini model)
 # -----------------------------------------------------
-@app.post("/ner")
-def ner(payload: TextIn):
-    prompt = f"""
+# <PREFIX>_CONCURRENCY calls in flight, <PREFIX>_RPS sustained / <PREFIX>_BURST
+# (RPS=0 disables the bucket), at most <PREFIX>_MAX_QUEUE callers waiting and
+# none of them longer than <PREFIX>_MAX_WAIT seconds; everyone else gets a 429.
+def _admission_env(prefix: str, concurrency: int, rps: float, burst: int) -> dict:
+    return {
+        "concurrency": int(os.getenv(f"{prefix}_CONCURRENCY", str(concurrency))),
+        "rate": float(os.getenv(f"{prefix}_RPS", str(rps))),
+        "burst": int(os.getenv(f"{prefix}_BURST", str(burst))),
+        "max_queue": int(os.getenv(f"{prefix}_MAX_QUEUE", "64")),
+        "max_wait": float(os.getenv(f"{prefix}_MAX_WAIT", "10")),
+    }
+
+
+class Overloaded(HTTPException):
+    """Shed request: surfaces as 429 with a Retry-After hint."""
+
+    def __init__(self, detail: str, retry_after: float = 1.0):
+        super().__init__(status_code=429, detail=detail, headers={"Retry-After": str(max(1, math.ceil(retry_after)))})
+
+
+def _is_quota_error(e: BaseException) -> bool:
+    # google.api_core.exceptions.ResourceExhausted / TooManyRequests, without importing google here
+    return type(e).__name__ in ("ResourceExhausted", "TooManyRequests") or getattr(e, "code", None) == 429
+
+
+class _SlotWaiter:
+    __slots__ = ("granted", "wake")
+
+    def __init__(self, wake: Callable[[], None]):
+        self.granted = False
+        self.wake = wake
+
+
+class AdmissionControl:
+    """Concurrency limit + token bucket + bounded wait queue for one model.
+
+    A caller first takes a concurrency slot, then a token. Slots are handed
+    over in FIFO order to one queue shared by threads (blocking on an Event)
+    and coroutines (awaiting a Future on their loop), so the async path never
+    parks a thread and a cancelled waiter just leaves the queue. Tokens are
+    reserved (the bucket may go negative) so waiters are served in arrival
+    order without polling. Callers that would queue past ``max_queue`` or wait
+    longer than ``max_wait`` are rejected straight away with Overloaded, which
+    keeps tail latency bounded instead of letting the queue grow. An upstream
+    quota error empties the bucket so the next callers back off too.
+    """
+
+    def __init__(self, name: str, concurrency: int, rate: float, burst: int, max_queue: int, max_wait: float):
+        self.name = name
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.concurrency = max(1, concurrency)
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._waiters: "deque[_SlotWaiter]" = deque()
+        self._tokens = float(self.burst)
+        self._refilled = time.monotonic()
+        self.stats = {"admitted": 0, "shed_queue": 0, "shed_wait": 0, "quota_errors": 0}
+
+    # ---- slots ----
+    def _queue_for_slot(self, wake: Callable[[], None]) -> Optional[_SlotWaiter]:
+        """Take a free slot (returns None) or join the wait queue (returns the waiter)."""
+        with self._lock:
+            if self._in_flight < self.concurrency and not self._waiters:
+                self._in_flight += 1
+                return None
+            if len(self._waiters) >= self.max_queue:
+                self.stats["shed_queue"] += 1
+                raise Overloaded(f"{self.name}: too many requests waiting")
+            waiter = _SlotWaiter(wake)
+            self._waiters.append(waiter)
+            return waiter
+
+    def _give_up(self, waiter: _SlotWaiter) -> bool:
+        """Leave the queue; True if the slot was handed over meanwhile (the caller now holds it)."""
+        with self._lock:
+            if waiter.granted:
+                return True
+            self._waiters.remove(waiter)
+            return False
+
+    def _release_slot(self):
+        with self._lock:
+            while self._waiters:
+                # hand the slot straight to the next waiter; in_flight stays the same
+                waiter = self._waiters.popleft()
+                try:
+                    waiter.wake()
+                except RuntimeError:
+                    continue  # its event loop is gone
+                waiter.granted = True
+                return
+            self._in_flight -= 1
+
+    def _take_token(self, deadline: float) -> float:
+        """Reserve a token; return how long to sleep for it, or raise if past the deadline."""
+        if self.rate <= 0:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._refilled) * self.rate)
+            self._refilled = now
+            delay = max(0.0, (1 - self._tokens) / self.rate)
+            if now + delay > deadline:
+                self.stats["shed_wait"] += 1
+                raise Overloaded(f"{self.name}: rate limit reached", retry_after=delay)
+            self._tokens -= 1
+            return delay
+
+    def _token_or_release(self, deadline: float) -> float:
+        try:
+            return self._take_token(deadline)
+        except Overloaded:
+            self._release_slot()
+            raise
+
+    def _shed_busy(self):
+        with self._lock:
+            self.stats["shed_wait"] += 1
+        raise Overloaded(f"{self.name}: all slots busy")
+
+    def _admitted(self):
+        with self._lock:
+            self.stats["admitted"] += 1
+
+    def _exit(self, error: Optional[BaseException]):
+        self._release_slot()
+        if error is not None and _is_quota_error(error):
+            with self._lock:
+                self.stats["quota_errors"] += 1
+                self._tokens = min(self._tokens, 0.0)
+            raise Overloaded(f"{self.name}: upstream quota exhausted", retry_after=1 / self.rate if self.rate > 0 else 1) from error
+
+    # ---- entry points ----
+    @contextmanager
+    def slot(self):
+        deadline = time.monotonic() + self.max_wait
+        event = threading.Event()
+        waiter = self._queue_for_slot(event.set)
+        if waiter is not None and not event.wait(self.max_wait) and not self._give_up(waiter):
+            self._shed_busy()
+        delay = self._token_or_release(deadline)
+        if delay:
+            time.sleep(delay)
+        self._admitted()
+        try:
+            yield
+        except BaseException as e:
+            self._exit(e)
+            raise
+        self._exit(None)
+
+    @asynccontextmanager
+    async def aslot(self):
+        deadline = time.monotonic() + self.max_wait
+        loop = asyncio.get_running_loop()
+        granted = loop.create_future()
+        # the slot may be released from any thread, so wake through the loop
+        waiter = self._queue_for_slot(lambda: loop.call_soon_threadsafe(
+            lambda: granted.done() or granted.set_result(None)))
+        if waiter is not None:
+            try:
+                await asyncio.wait_for(asyncio.shield(granted), self.max_wait)
+            except asyncio.TimeoutError:
+                if not self._give_up(waiter):
+                    self._shed_busy()
+            except asyncio.CancelledError:
+                if self._give_up(waiter):
+                    self._release_slot()
+                raise
+        delay = self._token_or_release(deadline)
+        if delay:
+            try:
+                await asyncio.sleep(delay)
+            except asyncio.CancelledError:
+                self._release_slot()
+                raise
+        self._admitted()
+        try:
+            yield
+        except BaseException as e:
+            self._exit(e)
+            raise
+        self._exit(None)
+
+    def status(self) -> dict:
+        with self._lock:
+            return dict(self.stats, in_flight=self._in_flight, waiting=len(self._waiters), tokens=round(self._tokens, 2))
+
+
+admission = {
+    GEMINI_MODEL: AdmissionControl(GEMINI_MODEL, **_admission_env("GEMINI_GEN", 8, 10, 20)),
+    GEMINI_EMBED_MODEL: AdmissionControl(GEMINI_EMBED_MODEL, **_admission_env("GEMINI_EMBED", 8, 25, 50)),
+}
+
+
+class SingleFlight:
+    """Collapses concurrent calls with the same key into one execution.
+
+    The first caller runs ``fn``; everyone arriving while it runs blocks on
+    the same Future and gets its result (or exception).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: Dict[object, Future] = {}
+        self.shared = 0
+
+    def do(self, key, fn: Callable[[], object]):
+        with self._lock:
+            fut = self._calls.get(key)
+            leader = fut is None
+            if leader:
+                fut = self._calls[key] = Future()
+            else:
+                self.shared += 1
+        if not leader:
+            return fut.result()
+        try:
+            result = fn()
+            fut.set_result(result)
+            return result
+        except BaseException as e:
+            fut.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+    def future(self, key, start: Callable[[], Future]) -> Future:
+        """Non-blocking variant: share the pending Future from ``start`` until it resolves."""
+        with self._lock:
+            fut = self._calls.get(key)
+            if fut is not None:
+                self.shared += 1
+                return fut
+            fut = self._calls[key] = start()
+        fut.add_done_callback(lambda _: self._forget(key, fut))
+        return fut
+
+    def _forget(self, key, fut: Future):
+        with self._lock:
+            if self._calls.get(key) is fut:
+                del self._calls[key]
+
+
+# identical in-flight model requests (same cache key) share one upstream call
+inflight = SingleFlight()
+
+
+@app.get("/admission/stats")
+def admission_stats():
+    return {"models": {m: a.status() for m, a in admission.items()}, "coalesced": inflight.shared}
+
+# -----------------------------------------------------
+# GEMINI HELPERS + MICRO-BATCHING
+# -----------------------------------------------------
+_JSON_CONFIG = {"response_mime_type": "application/json"}
+
+
+def _generate(prompt: str, json_mode: bool = False) -> str:
+    """Run one generate_content call on the shared model and return the text."""
+    with admission[GEMINI_MODEL].slot():
+        if json_mode:
+            response = gemini_model.generate_content(prompt, generation_config=_JSON_CONFIG)
+        else:
+            response = gemini_model.generate_content(prompt)
+        return response.text
+
+
+def _embed_one(text: str) -> List[float]:
+    with admission[GEMINI_EMBED_MODEL].slot():
+        return genai.embed_content(model=GEMINI_EMBED_MODEL, content=text)["embedding"]
+
+
+def _generate_stream(prompt: str):
+    """Yield text chunks as Gemini streams them."""
+    with admission[GEMINI_MODEL].slot():
+        for chunk in gemini_model.generate_content(prompt, stream=True):
+            try:
+                text = chunk.text
+            except ValueError:
+                # chunks without text parts (e.g. only safety metadata)
+                continue
+            if text:
+                yield text
+
+
+def _sse(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+def _sse_response(events) -> StreamingResponse:
+    return StreamingResponse(events, media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+def _parse_json(text: str):
+    """Parse a model reply as JSON, tolerating ```json fences."""
+    text = (text or "").strip()
+    if text.startswith("```"):
+        text = text.strip("`")
+        if text.lower().startswith("json"):
+            text = text[4:]
+    return json.loads(text)
+
+
+class GeminiBatcher:
+    """Collects concurrent requests for one task and sends them as a single prompt.
+
+    Callers block on a Future. A collector thread waits up to ``max_wait_ms``
+    for more items (or until ``max_batch_size``), packs them into one prompt
+    with item ids and fans the parsed results back out. Items that the batch
+    reply does not cover (or a batch call that fails outright) are retried one
+    by one, so a bad item only fails its own caller.
+    """
+
+    def __init__(self, name: str, single_prompt: Callable[[str], str], batch_instructions: str,
+                 max_batch_size: int = GEMINI_BATCH_MAX_SIZE, max_wait_ms: int = GEMINI_BATCH_MAX_WAIT_MS,
+                 workers: int = GEMINI_BATCH_WORKERS):
+        self.name = name
+        self.single_prompt = single_prompt
+        self.batch_instructions = batch_instructions
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max(0, max_wait_ms) / 1000.0
+        self.workers = max(1, workers)
+        self._queue: "queue.Queue[Tuple[str, Future]]" = queue.Queue()
+        self._lock = threading.Lock()
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    def submit(self, text: str) -> Future:
+        self._ensure_started()
+        fut: Future = Future()
+        self._queue.put((text, fut))
+        return fut
+
+    def __call__(self, text: str, timeout: Optional[float] = None):
+        return self.submit(text).result(timeout)
+
+    def _ensure_started(self):
+        if self._executor is not None:
+            return
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix=f"gemini-{self.name}")
+                threading.Thread(target=self._collect_loop, name=f"batcher-{self.name}", daemon=True).start()
+
+    def _collect_loop(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._executor.submit(self._dispatch, batch)
+
+    def _dispatch(self, batch: List[Tuple[str, Future]]):
+        try:
+            results: Dict[int, object] = {}
+            if len(batch) > 1:
+                try:
+                    results = self._run_batch([text for text, _ in batch])
+                except Overloaded:
+                    raise
+                except Exception as e:
+                    logger.warning("%s batch of %d failed, retrying items individually: %s", self.name, len(batch), e)
+            for i, (text, fut) in enumerate(batch):
+                if i in results:
+                    fut.set_result(results[i])
+                else:
+                    self._run_single(text, fut)
+        except Exception as e:
+            logger.exception("%s dispatcher error", self.name)
+            for _, fut in batch:
+                if not fut.done():
+                    fut.set_exception(e)
+
+    def _run_single(self, text: str, fut: Future):
+        try:
+            fut.set_result(_parse_json(_generate(self.single_prompt(text), json_mode=True)))
+        except Exception as e:
+            fut.set_exception(e)
+
+    def _run_batch(self, texts: List[str]) -> Dict[int, object]:
+        items = [{"id": i, "text": t} for i, t in enumerate(texts)]
+        prompt = f"""
+{self.batch_instructions}
+
+Items (JSON):
+{json.dumps(items, ensure_ascii=False)}
+
+Return a JSON array ONLY, one object per item:
+[{{"id": <item id>, "result": <result for that item>}}]
+"""
+        parsed = _parse_json(_generate(prompt, json_mode=True))
+        results: Dict[int, object] = {}
+        for entry in parsed if isinstance(parsed, list) else []:
+            if not isinstance(entry, dict) or "result" not in entry:
+                continue
+            try:
+                idx = int(entry.get("id"))
+            except (TypeError, ValueError):
+                continue
+            if 0 <= idx < len(texts):
+                results[idx] = entry["result"]
+        return results
+
+
+def _ner_prompt(text: str) -> str:
+    return f"""
 Extract named entities from the text in JSON.
-Text: "{payload.text}"
+Text: "{text}"
 
 Entities:
 - PERSON
@@ -100,36 +989,22 @@ Return JSON ONLY with:
     "entities":[{{"text":"...", "label":"..."}}]
 }}
     """
-    try:
-        response = genai.GenerativeModel("gemini-2.5-flash").generate_content(prompt)
-        return response.text
-    except Exception as e:
-        logger.exception("NER error")
-        return {"error": str(e)}
 
 
-@app.post("/classify")
-def classify(payload: TextIn):
-    prompt = f"""
+def _classify_prompt(text: str) -> str:
+    return f"""
 Classify the type of message in ONE WORD.
 Labels: STATEMENT, TASK, DECISION, QUESTION, MEETING, UPDATE, DEADLINE, OTHER.
-Text: "{payload.text}"
+Text: "{text}"
 
 Return JSON:
 {{"label":"..."}}"""
-    try:
-        response = genai.GenerativeModel("gemini-2.5-flash").generate_content(prompt)
-        return response.text
-    except Exception as e:
-        logger.exception("Classify error")
-        return {"error": str(e)}
 
 
-@app.post("/extract")
-def extract(payload: TextIn):
-    prompt = f"""
+def _extract_prompt(text: str) -> str:
+    return f"""
 Extract structured information in JSON.
-Text: "{payload.text}"
+Text: "{text}"
 
 Return JSON:
 {{
@@ -139,423 +1014,3271 @@ Return JSON:
   "owners": [...]
 }}
     """
-    try:
-        response = genai.GenerativeModel("gemini-2.5-flash").generate_content(prompt)
-        return response.text
-    except Exception as e:
-        logger.exception("Extract error")
-        return {"error": str(e)}
 
 
-@app.post("/embed")
-def embed(payload: TextIn):
-    try:
-        embedding = genai.embed_content(
-            model="models/text-embedding-004",
-            content=payload.text
-        )
-        return {"embedding": embedding['embedding']}
-    except Exception as e:
-        logger.exception("Embedding error")
-        return {"error": str(e)}
+ner_batcher = GeminiBatcher("ner", _ner_prompt, """
+Extract named entities from each item's text.
+Entities: PERSON, DATE, DEADLINE, TASK, DECISION, PROJECT, ORG, MEETING, LOCATION, PRODUCT, PRIORITY.
+Each result is: {"entities":[{"text":"...", "label":"..."}]}""")
 
+classify_batcher = GeminiBatcher("classify", _classify_prompt, """
+Classify the type of each item's message in ONE WORD.
+Labels: STATEMENT, TASK, DECISION, QUESTION, MEETING, UPDATE, DEADLINE, OTHER.
+Each result is: {"label":"..."}""")
 
-@app.post("/generate")
-def generate(payload: TextIn):
-    prompt = f"""
-Generate a helpful, short response to the message:
-"{payload.text}"
-"""
-    try:
-        response = genai.GenerativeModel("gemini-2.5-flash").generate_content(prompt)
-        return {"response": response.text}
-    except Exception as e:
-        logger.exception("Generate error")
-        return {"error": str(e)}
+extract_batcher = GeminiBatcher("extract", _extract_prompt, """
+Extract structured information from each item's text.
+Each result is: {"decisions": [...], "tasks": [...], "deadlines": [...], "owners": [...]}""")
 
-# -----------------------------------------------------
-# CHAT (in-memory) + DB
-# -----------------------------------------------------
-chat_memory: List[str] = []
 
-@app.post("/chat")
-def chat(payload: TextIn):
-    # save locally and respond
-    chat_memory.append(payload.text)
-    if len(chat_memory) > 50:
-        chat_memory.pop(0)
-    context_summary = " ".join(chat_memory[-8:])
-    prompt = f"""
-Context from previous messages:
-{context_summary}
-
-User: {payload.text}
+def _analyze_prompt(text: str) -> str:
+    return f"""
+Analyze the message below in ONE pass and return JSON.
+Text: "{text}"
 
-Respond concisely.
-"""
-    try:
-        response = genai.GenerativeModel("gemini-2.5-flash").generate_content(prompt)
-        reply = response.text
-    except Exception as e:
-        logger.exception("Chat error")
-        reply = "Sorry, I couldn't generate a response right now."
+entities: named entities, labels PERSON, DATE, DEADLINE, TASK, DECISION, PROJECT, ORG, MEETING, LOCATION, PRODUCT, PRIORITY.
+label: message type in ONE WORD, one of STATEMENT, TASK, DECISION, QUESTION, MEETING, UPDATE, DEADLINE, OTHER.
+decisions / tasks / deadlines / owners: structured information found in the text.
 
-    # store minimal chat history to supabase if available
-    if supabase:
-        try:
-            supabase.table("messages").insert({
-                "user_message": payload.text,
-                "bot_response": reply,
-                "source": "chat"
-            }).execute()
-        except Exception as e:
-            logger.warning("Failed to save chat to supabase: %s", e)
+Return JSON ONLY with:
+{ANALYZE_SCHEMA}
+    """
 
-    return {"response": reply}
 
+# shared schema for the single-pass route (entities + label + extraction)
+ANALYZE_SCHEMA = """{
+  "entities": [{"text": "...", "label": "..."}],
+  "label": "...",
+  "decisions": [...],
+  "tasks": [...],
+  "deadlines": [...],
+  "owners": [...]
+}"""
 
-@app.post("/chat_db")
-def chat_db(payload: TextIn):
+analyze_batcher = GeminiBatcher("analyze", _analyze_prompt, f"""
+Analyze each item's message in ONE pass.
+entities: named entities, labels PERSON, DATE, DEADLINE, TASK, DECISION, PROJECT, ORG, MEETING, LOCATION, PRODUCT, PRIORITY.
+label: message type in ONE WORD, one of STATEMENT, TASK, DECISION, QUESTION, MEETING, UPDATE, DEADLINE, OTHER.
+decisions / tasks / deadlines / owners: structured information found in the text.
+Each result is:
+{ANALYZE_SCHEMA}""")
+
+# -----------------------------------------------------
+# RESPONSE CACHE (memory LRU + optional sqlite)
+# -----------------------------------------------------
+# bump a version when its prompt/template changes so old answers stop matching
+PROMPT_VERSIONS = {
+    "ner": "1",
+    "classify": "1",
+    "extract": "1",
+    "analyze": "1",
+    "embed": "1",
+    "generate": "1",
+}
+
+
+def _normalize_text(text: str) -> str:
+    return " ".join(unicodedata.normalize("NFC", text or "").split())
+
+
+class ResponseCache:
+    """Content-addressed cache for model responses.
+
+    Keys are sha256(route, model, prompt version, normalized text). The memory
+    tier is an LRU bounded by ``max_entries`` with a TTL; when ``sqlite_path``
+    is set, entries are also written to a SQLite file that survives restarts
+    and is shared by every worker on the host. The memory lock never covers
+    disk I/O: SQLite reads use a per-thread connection (WAL lets them run
+    alongside the writer) and writes are queued to one writer thread that
+    commits them in batches.
+    """
+
+    WRITE_BATCH = 500
+    WRITE_INTERVAL = 0.5  # seconds a write may wait for its batch to fill
+
+    def __init__(self, max_entries: int = CACHE_MAX_ENTRIES, ttl_seconds: int = CACHE_TTL_SECONDS,
+                 sqlite_path: Optional[str] = CACHE_SQLITE_PATH, sqlite_max_entries: int = CACHE_SQLITE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.ttl = ttl_seconds
+        self.sqlite_max_entries = sqlite_max_entries
+        self._mem: "OrderedDict[str, Tuple[float, object]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats: Dict[str, Dict[str, int]] = {}
+        self._db: Optional[sqlite3.Connection] = None  # owned by the writer thread after __init__
+        self._db_writes = 0
+        self._sqlite_path = sqlite_path
+        self._local = threading.local()
+        self._writes: "queue.Queue[Optional[Tuple[str, str, float]]]" = queue.Queue()
+        self._writer: Optional[threading.Thread] = None
+        if sqlite_path:
+            try:
+                self._db = sqlite3.connect(sqlite_path, check_same_thread=False, timeout=5)
+                self._db.execute("PRAGMA journal_mode=WAL")
+                self._db.execute(
+                    "CREATE TABLE IF NOT EXISTS response_cache ("
+                    "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)"
+                )
+                self._db.execute("CREATE INDEX IF NOT EXISTS response_cache_exp ON response_cache(expires_at)")
+                self._db.commit()
+            except Exception as e:
+                logger.warning("Could not open cache db %s: %s", sqlite_path, e)
+                self._db = None
+        if self._db is not None:
+            self._writer = threading.Thread(target=self._write_loop, name="cache-writer", daemon=True)
+            self._writer.start()
+
+    @staticmethod
+    def make_key(route: str, model: str, text: str) -> str:
+        raw = "\x1f".join([route, model, PROMPT_VERSIONS.get(route, "0"), _normalize_text(text)])
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _count(self, route: str, field: str):
+        counters = self._stats.setdefault(route, {"memory_hits": 0, "disk_hits": 0, "misses": 0})
+        counters[field] += 1
+
+    def _reader(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = sqlite3.connect(self._sqlite_path, timeout=5)
+        return conn
+
+    def get(self, route: str, key: str):
+        """Return the cached value or None."""
+        hit = self._get_mem(route, key)
+        return hit if hit is not None else self._get_disk(route, key)
+
+    async def aget(self, route: str, key: str):
+        """``get`` for the event loop: memory inline, the SQLite lookup on a worker thread."""
+        hit = self._get_mem(route, key)
+        if hit is not None or self._db is None:
+            return hit if hit is not None else self._get_disk(route, key)
+        return await asyncio.to_thread(self._get_disk, route, key)
+
+    def _get_mem(self, route: str, key: str):
+        now = time.time()
+        with self._lock:
+            entry = self._mem.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self._mem.move_to_end(key)
+                    self._count(route, "memory_hits")
+                    return entry[1]
+                del self._mem[key]
+        return None
+
+    def _get_disk(self, route: str, key: str):
+        now = time.time()
+        row = None
+        if self._db is not None:
+            try:
+                row = self._reader().execute(
+                    "SELECT value, expires_at FROM response_cache WHERE key = ?", (key,)
+                ).fetchone()
+            except Exception as e:
+                logger.warning("Cache db read failed: %s", e)
+        with self._lock:
+            if row and row[1] > now:
+                value = json.loads(row[0])
+                self._put_mem(key, value, row[1])
+                self._count(route, "disk_hits")
+                return value
+            self._count(route, "misses")
+            return None
+
+    def set(self, key: str, value):
+        expires_at = time.time() + self.ttl
+        with self._lock:
+            self._put_mem(key, value, expires_at)
+        if self._db is not None:
+            self._writes.put((key, json.dumps(value), expires_at))
+
+    def _put_mem(self, key: str, value, expires_at: float):
+        self._mem[key] = (expires_at, value)
+        self._mem.move_to_end(key)
+        while len(self._mem) > self.max_entries:
+            self._mem.popitem(last=False)
+
+    def _write_loop(self):
+        stopping = False
+        while not stopping:
+            item = self._writes.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.WRITE_INTERVAL
+            while len(batch) < self.WRITE_BATCH:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._writes.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            try:
+                self._db.executemany(
+                    "INSERT OR REPLACE INTO response_cache (key, value, expires_at) VALUES (?, ?, ?)", batch
+                )
+                before = self._db_writes
+                self._db_writes += len(batch)
+                if self._db_writes // 1000 != before // 1000:
+                    self._prune_db()
+                self._db.commit()
+            except Exception as e:
+                logger.warning("Cache db write of %d entries failed: %s", len(batch), e)
+
+    def close(self):
+        """Flush queued disk writes."""
+        if self._writer is not None:
+            self._writes.put(None)
+            self._writer.join(timeout=10)
+            self._writer = None
+
+    def _prune_db(self):
+        self._db.execute("DELETE FROM response_cache WHERE expires_at <= ?", (time.time(),))
+        self._db.execute(
+            "DELETE FROM response_cache WHERE key IN ("
+            "SELECT key FROM response_cache ORDER BY expires_at DESC LIMIT -1 OFFSET ?)",
+            (self.sqlite_max_entries,),
+        )
+
+    def stats(self) -> dict:
+        with self._lock:
+            routes = {r: dict(c) for r, c in self._stats.items()}
+            size = len(self._mem)
+        totals = {"memory_hits": 0, "disk_hits": 0, "misses": 0}
+        for counters in routes.values():
+            for field, n in counters.items():
+                totals[field] += n
+        lookups = sum(totals.values())
+        hit_rate = (totals["memory_hits"] + totals["disk_hits"]) / lookups if lookups else 0.0
+        return {
+            "memory_entries": size,
+            "disk_enabled": self._db is not None,
+            "totals": totals,
+            "hit_rate": round(hit_rate, 4),
+            "routes": routes,
+        }
+
+
+response_cache = ResponseCache()
+
+
+@app.on_event("shutdown")
+def _close_response_cache():
+    response_cache.close()
+
+
+def cached_call(route: str, model: str, text: str, compute: Callable[[], object]):
+    """Return the cached response for (route, model, text) or compute and store it.
+
+    Concurrent misses for the same key share one ``compute`` call.
+    """
+    key = ResponseCache.make_key(route, model, text)
+    hit = response_cache.get(route, key)
+    if hit is not None:
+        return hit
+
+    def _compute():
+        value = compute()
+        response_cache.set(key, value)
+        return value
+
+    return inflight.do(key, _compute)
+
+
+def cached_submit(route: str, batcher: "GeminiBatcher", text: str,
+                  on_fresh: Optional[Callable[[object], None]] = None) -> Future:
+    """Like ``batcher.submit`` but answers from the cache and stores fresh results.
+
+    A text already waiting in the batcher is not submitted twice; callers share its Future.
+    ``on_fresh`` runs once per result actually computed by the model (never for cache hits).
+    """
+    key = ResponseCache.make_key(route, GEMINI_MODEL, text)
+    hit = response_cache.get(route, key)
+    if hit is not None:
+        fut: Future = Future()
+        fut.set_result(hit)
+        return fut
+    return _submit_uncached(key, batcher, text, on_fresh)
+
+
+def _submit_uncached(key: str, batcher: "GeminiBatcher", text: str,
+                     on_fresh: Optional[Callable[[object], None]] = None) -> Future:
+    def _start() -> Future:
+        fut = batcher.submit(text)
+
+        def _store(done: Future):
+            if not done.cancelled() and done.exception() is None:
+                response_cache.set(key, done.result())
+                if on_fresh is not None:
+                    on_fresh(done.result())
+
+        fut.add_done_callback(_store)
+        return fut
+
+    return inflight.future(key, _start)
+
+
+@app.get("/cache/stats")
+def cache_stats():
+    return response_cache.stats()
+
+# -----------------------------------------------------
+# LOCAL PRE-CLASSIFIER (rules + hashed n-gram logistic regression)
+# -----------------------------------------------------
+# classify/ner answer trivial messages locally; only uncertain ones reach Gemini
+PRECLASSIFY = os.getenv("PRECLASSIFY", "1").lower() in ("1", "true", "yes")
+PRECLASSIFY_DIR = os.getenv("PRECLASSIFY_DIR", os.path.join(tempfile.gettempdir(), "preclassifier"))
+PRECLASSIFY_THRESHOLD = float(os.getenv("PRECLASSIFY_THRESHOLD", "0.9"))  # min model probability to skip the LLM
+PRECLASSIFY_FEATURES = int(os.getenv("PRECLASSIFY_FEATURES", str(2 ** 18)))
+PRECLASSIFY_MIN_EXAMPLES = int(os.getenv("PRECLASSIFY_MIN_EXAMPLES", "200"))
+PRECLASSIFY_MAX_EXAMPLES = int(os.getenv("PRECLASSIFY_MAX_EXAMPLES", "200000"))
+PRECLASSIFY_LABELS_MAX_MB = float(os.getenv("PRECLASSIFY_LABELS_MAX_MB", "64"))  # labels.jsonl rotates to .1 past this
+PRECLASSIFY_EPOCHS = int(os.getenv("PRECLASSIFY_EPOCHS", "8"))
+
+CLASSIFY_LABELS = ["STATEMENT", "TASK", "DECISION", "QUESTION", "MEETING", "UPDATE", "DEADLINE", "OTHER"]
+
+# custom emoji, user/role/channel mentions and links carry no classifiable text
+_MARKUP_RE = re.compile(r"<a?:\w+:\d+>|<@[!&]?\d+>|<#\d+>|https?://\S+")
+_ACKS = {"+1", "-1", "ok", "okay", "k", "kk", "ty", "thx", "thanks", "lol", "lmao", "nice", "cool", "gg"}
+_TOKEN_RE = re.compile(r"\w+|[^\w\s]")
+
+
+def _is_trivial(text: str, author_bot: bool = False) -> bool:
+    """Empty, emoji/markup/link-only, a one-word ack, or posted by a bot."""
+    if author_bot:
+        return True
+    stripped = _MARKUP_RE.sub(" ", text or "")
+    if not any(unicodedata.category(c)[0] in "LN" for c in stripped):
+        return True
+    return _normalize_text(stripped).lower().strip(" .!") in _ACKS
+
+
+def _hash_features(text: str, n_features: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Sparse L2-normalized (indices, values): words, word bigrams and char trigrams, crc32-hashed."""
+    t = _normalize_text(text).lower()
+    words = _TOKEN_RE.findall(t)
+    padded = f" {t} "
+    grams = words + [f"{a} {b}" for a, b in zip(words, words[1:])] + ["#" + padded[i:i + 3] for i in range(len(padded) - 2)]
+    if not grams:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+    idx = np.fromiter((zlib.crc32(g.encode("utf-8")) for g in grams), dtype=np.int64, count=len(grams)) % n_features
+    idx, counts = np.unique(idx, return_counts=True)
+    val = (1 + np.log(counts)).astype(np.float32)
+    return idx, val / np.linalg.norm(val)
+
+
+class PreClassifier:
+    """First stages of the classify/ner cascade.
+
+    Stage 1 is rules (``_is_trivial``): answered as OTHER with no entities.
+    Stage 2, classify only, is a multinomial logistic regression over hashed
+    n-grams kept as one dense (n_features, n_labels) float32 matrix; a
+    prediction touches only the rows of the message's features. Answers at or
+    above ``threshold`` are returned, everything else escalates to Gemini.
+
+    Training data is what Gemini already answered (appended to labels.jsonl
+    as escalations come back), examples posted to /classify/train, and
+    optionally labeled rows in ``messages``. The trained weights live in
+    model.npz next to it; every worker reloads it when the file changes
+    (checked at most every RELOAD_CHECK_SECONDS).
+    """
+
+    RELOAD_CHECK_SECONDS = 5.0
+
+    def __init__(self, directory: str = PRECLASSIFY_DIR, n_features: int = PRECLASSIFY_FEATURES,
+                 threshold: float = PRECLASSIFY_THRESHOLD):
+        self.dir = directory
+        self.n_features = n_features
+        self.threshold = threshold
+        self.model_path = os.path.join(directory, "model.npz")
+        self.labels_path = os.path.join(directory, "labels.jsonl")
+        self._W: Optional[np.ndarray] = None
+        self._b: Optional[np.ndarray] = None
+        self._meta: dict = {}
+        self._stamp: Optional[tuple] = None  # model.npz identity the weights came from
+        self._checked_at = -math.inf
+        self._lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self.requests = {"classify": 0, "ner": 0}
+        self.stages = {s: {"answered": 0, "seconds": 0.0} for s in ("rules", "model", "llm")}
+
+    # ---- model ----
+    def _model_stamp(self) -> Optional[tuple]:
+        try:
+            st = os.stat(self.model_path)
+        except OSError:
+            return None
+        # train() swaps the file in with os.replace, so the inode changes too
+        return st.st_ino, st.st_mtime_ns, st.st_size
+
+    def _ensure_loaded(self):
+        """(Re)load model.npz when it changed, e.g. after another worker trained."""
+        now = time.monotonic()
+        if now - self._checked_at < self.RELOAD_CHECK_SECONDS:
+            return
+        with self._lock:
+            if now - self._checked_at < self.RELOAD_CHECK_SECONDS:
+                return
+            self._checked_at = now
+            stamp = self._model_stamp()
+            if stamp == self._stamp:
+                return
+            self._stamp = stamp
+            if stamp is None:
+                return  # keep whatever is loaded; a missing file is retried on the next check
+            try:
+                data = np.load(self.model_path)
+                if int(data["n_features"]) == self.n_features and list(data["labels"]) == CLASSIFY_LABELS:
+                    self._W, self._b = data["W"], data["b"]
+                    self._meta = json.loads(str(data["meta"]))
+                else:
+                    logger.warning("Ignoring %s: trained with a different feature size or label set", self.model_path)
+            except Exception as e:
+                logger.warning("Could not load pre-classifier %s: %s", self.model_path, e)
+
+    def _predict(self, text: str) -> Optional[Tuple[str, float]]:
+        self._ensure_loaded()
+        W, b = self._W, self._b
+        if W is None:
+            return None
+        idx, val = _hash_features(text, self.n_features)
+        z = val @ W[idx] + b
+        p = np.exp(z - z.max())
+        p /= p.sum()
+        best = int(p.argmax())
+        return CLASSIFY_LABELS[best], float(p[best])
+
+    # ---- cascade ----
+    def _record(self, route: str, stage: str, started: float):
+        with self._stats_lock:
+            self.requests[route] += 1
+            self.stages[stage]["answered"] += 1
+            self.stages[stage]["seconds"] += time.perf_counter() - started
+
+    def classify(self, text: str, author_bot: bool = False) -> Optional[dict]:
+        """Local answer for /classify, or None to escalate."""
+        if not PRECLASSIFY:
+            return None
+        started = time.perf_counter()
+        if _is_trivial(text, author_bot):
+            self._record("classify", "rules", started)
+            return {"label": "OTHER"}
+        prediction = self._predict(text)
+        if prediction is not None and prediction[1] >= self.threshold:
+            self._record("classify", "model", started)
+            return {"label": prediction[0]}
+        return None
+
+    def ner(self, text: str, author_bot: bool = False) -> Optional[dict]:
+        if not PRECLASSIFY:
+            return None
+        started = time.perf_counter()
+        if _is_trivial(text, author_bot):
+            self._record("ner", "rules", started)
+            return {"entities": []}
+        return None
+
+    def escalated(self, route: str, started: float):
+        self._record(route, "llm", started)
+
+    def observe(self, text: str, result) -> None:
+        """Keep a fresh Gemini label (not a cache hit) as a future training example."""
+        label = result.get("label") if isinstance(result, dict) else None
+        if label not in CLASSIFY_LABELS:
+            return
+        try:
+            os.makedirs(self.dir, exist_ok=True)
+            with self._lock:
+                with open(self.labels_path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps({"text": text, "label": label}, ensure_ascii=False) + "\n")
+                    size = f.tell()
+                # keep at most two files: the current one and the previous generation
+                if size > PRECLASSIFY_LABELS_MAX_MB * 1024 * 1024:
+                    os.replace(self.labels_path, self.labels_path + ".1")
+        except OSError as e:
+            logger.warning("Could not record pre-classifier label: %s", e)
+
+    # ---- training ----
+    def _stored_examples(self, from_db: bool) -> Dict[str, str]:
+        examples: Dict[str, str] = {}
+        lines: deque = deque(maxlen=PRECLASSIFY_MAX_EXAMPLES)
+        for path in (self.labels_path + ".1", self.labels_path):  # oldest first
+            if os.path.exists(path):
+                with open(path, encoding="utf-8") as f:
+                    lines.extend(f)
+        for line in lines:
+            try:
+                row = json.loads(line)
+            except ValueError:
+                continue
+            examples[row["text"]] = row["label"]
+        if from_db and supabase:
+            try:
+                rows = supabase.table("messages").select("content,label").not_.is_("label", "null") \
+                    .limit(PRECLASSIFY_MAX_EXAMPLES).execute()
+                for row in rows.data or []:
+                    if row.get("content"):
+                        examples[row["content"]] = str(row["label"]).upper()
+            except Exception as e:
+                logger.warning("Could not read labeled messages: %s", e)
+        return examples
+
+    def train(self, extra: List[Tuple[str, str]], from_db: bool = False, epochs: int = PRECLASSIFY_EPOCHS) -> dict:
+        """Fit on stored + posted examples with sparse SGD; replaces the model if there is enough data."""
+        examples = self._stored_examples(from_db)
+        for text, label in extra:
+            examples[text] = label.upper()
+        data = [(t, CLASSIFY_LABELS.index(l)) for t, l in examples.items()
+                if l in CLASSIFY_LABELS and not _is_trivial(t)]
+        if len(data) < PRECLASSIFY_MIN_EXAMPLES:
+            return {"trained": False, "examples": len(data), "min_examples": PRECLASSIFY_MIN_EXAMPLES}
+
+        rng = np.random.default_rng(0)
+        rng.shuffle(data)
+        feats = [_hash_features(t, self.n_features) for t, _ in data]
+        ys = np.array([y for _, y in data])
+        n_holdout = max(1, len(data) // 10)
+        train_ids = np.arange(n_holdout, len(data))
+
+        n_labels = len(CLASSIFY_LABELS)
+        W = np.zeros((self.n_features, n_labels), dtype=np.float32)
+        b = np.zeros(n_labels, dtype=np.float32)
+        l2 = 1e-5
+        for epoch in range(epochs):
+            lr = 0.5 / (1 + epoch)
+            for i in rng.permutation(train_ids):
+                idx, val = feats[i]
+                z = val @ W[idx] + b
+                p = np.exp(z - z.max())
+                p /= p.sum()
+                p[ys[i]] -= 1.0  # gradient of the log loss wrt z
+                W[idx] -= lr * (np.outer(val, p) + l2 * W[idx])
+                b -= lr * p
+
+        # holdout: accuracy overall, and how much would skip the LLM at the threshold
+        correct = confident = confident_correct = 0
+        for i in range(n_holdout):
+            idx, val = feats[i]
+            z = val @ W[idx] + b
+            p = np.exp(z - z.max())
+            p /= p.sum()
+            hit = bool(p.argmax() == ys[i])
+            correct += hit
+            if p.max() >= self.threshold:
+                confident += 1
+                confident_correct += hit
+        meta = {
+            "examples": len(data),
+            "holdout": n_holdout,
+            "holdout_accuracy": round(correct / n_holdout, 4),
+            "holdout_coverage": round(confident / n_holdout, 4),
+            "holdout_confident_accuracy": round(confident_correct / confident, 4) if confident else None,
+            "trained_at": datetime.now(timezone.utc).isoformat(),
+        }
+
+        os.makedirs(self.dir, exist_ok=True)
+        tmp = self.model_path + ".tmp.npz"
+        np.savez(tmp, W=W, b=b, labels=np.array(CLASSIFY_LABELS), n_features=self.n_features, meta=json.dumps(meta))
+        os.replace(tmp, self.model_path)
+        with self._lock:
+            self._W, self._b, self._meta = W, b, meta
+            self._stamp = self._model_stamp()
+        return dict(meta, trained=True)
+
+    def stats(self) -> dict:
+        self._ensure_loaded()
+        with self._stats_lock:
+            total = sum(self.requests.values())
+            stages = {
+                s: {"answered": c["answered"],
+                    "avg_ms": round(1000 * c["seconds"] / c["answered"], 3) if c["answered"] else None}
+                for s, c in self.stages.items()
+            }
+            return {
+                "enabled": PRECLASSIFY,
+                "requests": dict(self.requests),
+                "escalation_rate": round(self.stages["llm"]["answered"] / total, 4) if total else 0.0,
+                "stages": stages,
+                "model": dict(self._meta, loaded=self._W is not None, threshold=self.threshold),
+            }
+
+
+preclassifier = PreClassifier()
+
+
+class LabeledText(BaseModel):
+    text: str
+    label: str
+
+
+class TrainIn(BaseModel):
+    examples: List[LabeledText] = []
+    from_db: bool = False  # also use messages rows with a non-null label
+
+
+@app.post("/classify/train")
+def classify_train(payload: TrainIn):
+    return preclassifier.train([(e.text, e.label) for e in payload.examples], from_db=payload.from_db)
+
+
+@app.get("/classify/stats")
+def classify_stats():
+    return preclassifier.stats()
+
+# -----------------------------------------------------
+# SIMPLE GEMINI ROUTES
+# -----------------------------------------------------
+@app.post("/ner")
+def ner(payload: TextIn):
+    local = preclassifier.ner(payload.text)
+    if local is not None:
+        return local
+    started = time.perf_counter()
+    try:
+        result = cached_submit("ner", ner_batcher, payload.text).result()
+        preclassifier.escalated("ner", started)
+        return result
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.exception("NER error")
+        return {"error": str(e)}
+
+
+@app.post("/classify")
+def classify(payload: TextIn):
+    local = preclassifier.classify(payload.text)
+    if local is not None:
+        return local
+    started = time.perf_counter()
+    try:
+        result = cached_submit("classify", classify_batcher, payload.text,
+                               on_fresh=lambda r: preclassifier.observe(payload.text, r)).result()
+        preclassifier.escalated("classify", started)
+        return result
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.exception("Classify error")
+        return {"error": str(e)}
+
+
+@app.post("/extract")
+def extract(payload: TextIn):
+    try:
+        return cached_submit("extract", extract_batcher, payload.text).result()
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.exception("Extract error")
+        return {"error": str(e)}
+
+
+@app.post("/analyze")
+def analyze(payload: TextIn):
+    """NER + classification + extraction from one model call."""
+    try:
+        return cached_submit("analyze", analyze_batcher, payload.text).result()
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.exception("Analyze error")
+        return {"error": str(e)}
+
+
+@app.post("/analyze/batch")
+def analyze_batch(payload: TextsIn):
+    # submit everything first so the batcher can pack the texts together
+    futures = [cached_submit("analyze", analyze_batcher, t) for t in payload.texts]
+    results = []
+    for fut in futures:
+        try:
+            results.append(fut.result())
+        except Exception as e:
+            logger.warning("Analyze batch item error: %s", e)
+            results.append({"error": str(e)})
+    return {"results": results}
+
+
+@app.post("/embed")
+def embed(payload: TextIn):
+    try:
+        vector = cached_call("embed", GEMINI_EMBED_MODEL, payload.text, lambda: _embed_one(payload.text))
+        return {"embedding": vector}
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.exception("Embedding error")
+        return {"error": str(e)}
+
+
+def _generate_prompt(text: str) -> str:
+    return f"""
+Generate a helpful, short response to the message:
+"{text}"
+"""
+
+
+@app.post("/generate")
+def generate(payload: TextIn):
+    prompt = _generate_prompt(payload.text)
+    try:
+        return {"response": cached_call("generate", GEMINI_MODEL, payload.text, lambda: _generate(prompt))}
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.exception("Generate error")
+        return {"error": str(e)}
+
+
+@app.post("/generate/stream")
+def generate_stream(payload: TextIn):
+    """SSE: ``token`` events as text arrives, then ``done`` with the full response."""
+    key = ResponseCache.make_key("generate", GEMINI_MODEL, payload.text)
+
+    def events():
+        cached = response_cache.get("generate", key)
+        if cached is not None:
+            yield _sse("token", cached)
+            yield _sse("done", {"response": cached})
+            return
+        parts = []
+        try:
+            for text in _generate_stream(_generate_prompt(payload.text)):
+                parts.append(text)
+                yield _sse("token", text)
+        except Exception as e:
+            logger.exception("Generate stream error")
+            yield _sse("error", {"error": str(e)})
+            return
+        reply = "".join(parts)
+        response_cache.set(key, reply)
+        yield _sse("done", {"response": reply})
+
+    return _sse_response(events())
+
+# -----------------------------------------------------
+# BATCH EMBEDDINGS + LOCAL VECTOR INDEX
+# -----------------------------------------------------
+EMBED_BATCH_LIMIT = 100  # max contents per Gemini batch embedding call
+
+
+def _embed_texts(texts: List[str]) -> List[List[float]]:
+    """Embed many texts, answering repeats from the cache and the rest in batch calls."""
+    vectors: List[Optional[List[float]]] = [None] * len(texts)
+    missing: Dict[str, List[int]] = {}
+    for i, text in enumerate(texts):
+        key = ResponseCache.make_key("embed", GEMINI_EMBED_MODEL, text)
+        hit = response_cache.get("embed", key)
+        if hit is not None:
+            vectors[i] = hit
+        else:
+            missing.setdefault(key, []).append(i)
+
+    keys = list(missing)
+    for start in range(0, len(keys), EMBED_BATCH_LIMIT):
+        chunk = keys[start:start + EMBED_BATCH_LIMIT]
+        with admission[GEMINI_EMBED_MODEL].slot():
+            result = genai.embed_content(
+                model=GEMINI_EMBED_MODEL,
+                content=[texts[missing[k][0]] for k in chunk]
+            )
+        for key, vector in zip(chunk, result["embedding"]):
+            response_cache.set(key, vector)
+            for i in missing[key]:
+                vectors[i] = vector
+    return vectors
+
+
+class VectorIndex:
+    """Cosine-similarity index over one contiguous float32 matrix.
+
+    Rows are L2-normalized on insert so search is a single matrix-vector
+    product followed by ``argpartition`` for the top k. Re-adding an id
+    overwrites its row in place.
+    """
+
+    def __init__(self, initial_capacity: int = 1024):
+        self.dim: Optional[int] = None
+        self._capacity = initial_capacity
+        self._matrix: Optional[np.ndarray] = None
+        self._ids: List[str] = []
+        self._rows: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __contains__(self, msg_id: str) -> bool:
+        return msg_id in self._rows
+
+    def add(self, ids: List[str], vectors) -> int:
+        vecs = _unit_rows(vectors)
+        if len(ids) != vecs.shape[0]:
+            raise ValueError("ids and vectors must have the same length")
+        with self._lock:
+            if self._matrix is None:
+                self.dim = vecs.shape[1]
+                self._matrix = np.zeros((self._capacity, self.dim), dtype=np.float32)
+            elif vecs.shape[1] != self.dim:
+                raise ValueError(f"expected dim {self.dim}, got {vecs.shape[1]}")
+            for msg_id, vec in zip(ids, vecs):
+                row = self._rows.get(msg_id)
+                if row is None:
+                    row = len(self._ids)
+                    if row >= self._matrix.shape[0]:
+                        grown = np.zeros((self._matrix.shape[0] * 2, self.dim), dtype=np.float32)
+                        grown[:row] = self._matrix[:row]
+                        self._matrix = grown
+                    self._ids.append(msg_id)
+                    self._rows[msg_id] = row
+                self._matrix[row] = vec
+        return len(ids)
+
+    def search(self, query, k: int = 10) -> List[Tuple[str, float]]:
+        with self._lock:
+            n = len(self._ids)
+            if n == 0 or k <= 0:
+                return []
+            matrix = self._matrix[:n]
+            ids = self._ids
+        q = _unit_rows(query)[0]
+        scores = matrix @ q
+        return _top_k(ids, scores, k)
+
+
+def _unit_rows(vectors) -> np.ndarray:
+    vecs = np.array(vectors, dtype=np.float32, ndmin=2)
+    norms = np.linalg.norm(vecs, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vecs / norms
+
+
+def _top_k(ids: List[str], scores: np.ndarray, k: int) -> List[Tuple[str, float]]:
+    k = min(k, scores.shape[0])
+    if k < scores.shape[0]:
+        top = np.argpartition(-scores, k - 1)[:k]
+    else:
+        top = np.arange(scores.shape[0])
+    top = top[np.argsort(-scores[top])]
+    return [(ids[i], float(scores[i])) for i in top]
+
+
+class MmapEmbeddingStore:
+    """Append-only on-disk embedding store searched through read-only mmaps.
+
+    Files, next to each other under ``prefix``:
+      .meta.json  dim + storage dtype
+      .vec        row-major vectors (float32, float16 or int8)
+      .scale      float32 per-row scale (int8 only; row ~= int8 * scale)
+      .ids        one id per line, in row order
+      .off        int64 per row: byte offset of its line in .ids
+      .stale      uint8 per row: 1 once a later row re-added the same id
+      .idx        open-addressing hash table of (hash64(id), row + 1) pairs
+
+    Vectors are unit-normalized before quantizing so search is a dot product.
+    Everything per row lives in these files, so a worker's memory does not
+    grow with the store: the OS page cache is shared by every process that
+    maps it. Searches scan .vec in blocks of SEARCH_BLOCK_ROWS (a few MB of
+    float32 scratch each). Appends take an flock, so several workers can write
+    the same store; a row becomes visible once its .off entry is written, and
+    readers pick it up on their next call. Re-adding an id appends a new row
+    and marks the older one stale.
+    """
+
+    DTYPES = {"float32": np.float32, "float16": np.float16, "int8": np.int8}
+    SEARCH_BLOCK_ROWS = 4096  # 12 MB of float32 scratch per block at dim 768
+    MIN_INDEX_SLOTS = 1024
+
+    def __init__(self, prefix: str, dtype: str = EMBED_STORE_DTYPE):
+        if dtype not in self.DTYPES:
+            raise ValueError(f"unsupported embedding store dtype: {dtype}")
+        self.prefix = prefix
+        self.dim: Optional[int] = None
+        self.dtype = dtype
+        self._np_dtype = self.DTYPES[dtype]
+        self._load_meta()
+        self._n = 0
+        self._mapped: Optional[tuple] = None
+        self._off = self._vec = self._scale = self._stale = self._idx = self._ids = None
+        self._lock = threading.Lock()
+        if os.path.exists(prefix + ".ids") and not os.path.exists(prefix + ".off"):
+            # store written before .off/.stale/.idx existed: derive them once
+            with self._lock, self._file_lock():
+                self._migrate()
+        with self._lock:
+            self._refresh()
+
+    def __len__(self):
+        # refresh first: another worker may have created or grown the store
+        with self._lock:
+            self._refresh()
+            return self._n - int(self._stale.sum()) if self._n else 0
+
+    def __contains__(self, msg_id: str) -> bool:
+        with self._lock:
+            self._refresh()
+            return self._n > 0 and self._probe(self._idx, msg_id, self._n)[1] is not None
+
+    # ---- files ----
+    def _load_meta(self):
+        """Adopt dim/dtype from .meta.json once some writer has created it."""
+        try:
+            with open(self.prefix + ".meta.json") as f:
+                meta = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return
+        if meta["dtype"] != self.dtype:
+            logger.warning("Embedding store %s is %s; ignoring requested %s", self.prefix, meta["dtype"], self.dtype)
+        self.dim, self.dtype = meta["dim"], meta["dtype"]
+        self._np_dtype = self.DTYPES[self.dtype]
+
+    @contextmanager
+    def _file_lock(self):
+        with open(self.prefix + ".lock", "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _row_bytes(self) -> int:
+        return self.dim * np.dtype(self._np_dtype).itemsize
+
+    def _size(self, suffix: str) -> int:
+        try:
+            return os.path.getsize(self.prefix + suffix)
+        except FileNotFoundError:
+            return 0
+
+    def _refresh(self):
+        """Remap when rows were published or the index was rebuilt (by us or another worker)."""
+        if self.dim is None:
+            self._load_meta()
+        if self.dim is None:
+            return
+        n = self._size(".off") // 8
+        try:
+            st = os.stat(self.prefix + ".idx")
+        except FileNotFoundError:
+            return
+        key = (n, st.st_ino, st.st_size)
+        if key == self._mapped:
+            return
+        p = self.prefix
+        self._idx = np.memmap(p + ".idx", dtype=np.uint64, mode="r", shape=(st.st_size // 16, 2))
+        if n:
+            self._off = np.memmap(p + ".off", dtype=np.int64, mode="r", shape=(n,))
+            self._vec = np.memmap(p + ".vec", dtype=self._np_dtype, mode="r", shape=(n, self.dim))
+            self._stale = np.memmap(p + ".stale", dtype=np.uint8, mode="r", shape=(n,))
+            if self.dtype == "int8":
+                self._scale = np.memmap(p + ".scale", dtype=np.float32, mode="r", shape=(n,))
+            with open(p + ".ids", "rb") as f:
+                self._ids = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._n = n
+        self._mapped = key
+
+    # ---- id index ----
+    @staticmethod
+    def _hash(msg_id: str) -> int:
+        h = int.from_bytes(hashlib.blake2b(msg_id.encode("utf-8"), digest_size=8).digest(), "little")
+        return h or 1  # 0 marks an empty slot
+
+    @staticmethod
+    def _read_id(off, ids, row: int) -> str:
+        start = int(off[row])
+        return ids[start:ids.find(b"\n", start)].decode("utf-8")
+
+    def _probe(self, idx, msg_id: str, n: int, off=None, ids=None) -> Tuple[int, Optional[int]]:
+        """(slot, row) of ``msg_id`` among the first n rows, or (free slot, None)."""
+        off = self._off if off is None else off
+        ids = self._ids if ids is None else ids
+        h = self._hash(msg_id)
+        mask = idx.shape[0] - 1
+        slot = h & mask
+        while True:
+            slot_hash, slot_row = int(idx[slot, 0]), int(idx[slot, 1])
+            if slot_hash == 0:
+                return slot, None
+            # the hash only narrows it down; the id itself is compared from .ids
+            if slot_hash == h and 0 < slot_row <= n and self._read_id(off, ids, slot_row - 1) == msg_id:
+                return slot, slot_row - 1
+            slot = (slot + 1) & mask
+
+    def _writable(self, suffix: str, dtype, shape) -> np.memmap:
+        return np.memmap(self.prefix + suffix, dtype=dtype, mode="r+", shape=shape)
+
+    def _rebuild_index(self, n: int):
+        """Rewrite .idx (and the stale marks) from the first n rows; swapped in atomically."""
+        slots = self.MIN_INDEX_SLOTS
+        while slots < 4 * n:
+            slots *= 2
+        tmp = f"{self.prefix}.idx.{os.getpid()}.tmp"
+        table = np.memmap(tmp, dtype=np.uint64, mode="w+", shape=(slots, 2))
+        if n:
+            stale = self._writable(".stale", np.uint8, (n,))
+            stale[:] = 0
+            off = np.memmap(self.prefix + ".off", dtype=np.int64, mode="r", shape=(n,))
+            with open(self.prefix + ".ids", "rb") as f:
+                ids = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            for row in range(n):
+                msg_id = self._read_id(off, ids, row)
+                slot, prev = self._probe(table, msg_id, n, off, ids)
+                if prev is not None:
+                    stale[prev] = 1
+                table[slot] = (self._hash(msg_id), row + 1)
+            stale.flush()
+        table.flush()
+        del table
+        os.replace(tmp, self.prefix + ".idx")
+
+    def _migrate(self):
+        """Build .off/.stale/.idx for a store that only has .vec and .ids."""
+        if self.dim is None or os.path.exists(self.prefix + ".off"):
+            return  # empty, or another worker migrated it while we waited
+        n_vec = self._size(".vec") // self._row_bytes()
+        offsets, pos = [], 0
+        with open(self.prefix + ".ids", "rb") as f:
+            for line in f:
+                if len(offsets) == n_vec or not line.endswith(b"\n"):
+                    break
+                offsets.append(pos)
+                pos += len(line)
+        with open(self.prefix + ".stale", "wb") as f:
+            f.truncate(len(offsets))
+        tmp = f"{self.prefix}.off.{os.getpid()}.tmp"
+        np.array(offsets, dtype=np.int64).tofile(tmp)
+        os.replace(tmp, self.prefix + ".off")
+        self._trim(len(offsets), ids_end=pos)
+        # readers need .idx before they map anything, so the rows appear only now
+        self._rebuild_index(len(offsets))
+
+    def _trim(self, n: int, ids_end: Optional[int] = None):
+        """Drop bytes a crashed writer left past the last published row."""
+        if ids_end is None:
+            ids_end = 0
+            if n:
+                off = np.memmap(self.prefix + ".off", dtype=np.int64, mode="r", shape=(n,))
+                with open(self.prefix + ".ids", "rb") as f:
+                    f.seek(int(off[n - 1]))
+                    ids_end = int(off[n - 1]) + len(f.readline())
+        sizes = {".vec": n * self._row_bytes(), ".ids": ids_end, ".stale": n, ".off": n * 8}
+        if self.dtype == "int8":
+            sizes[".scale"] = n * 4
+        for suffix, size in sizes.items():
+            if self._size(suffix) > size:
+                os.truncate(self.prefix + suffix, size)
+
+    # ---- writes ----
+    def _encode(self, vecs: np.ndarray) -> Tuple[bytes, Optional[bytes]]:
+        if self.dtype == "int8":
+            scale = np.abs(vecs).max(axis=1) / 127.0
+            scale[scale == 0] = 1.0
+            q = np.clip(np.rint(vecs / scale[:, None]), -127, 127).astype(np.int8)
+            return q.tobytes(), scale.astype(np.float32).tobytes()
+        return vecs.astype(self._np_dtype).tobytes(), None
+
+    def add(self, ids: List[str], vectors) -> int:
+        vecs = _unit_rows(vectors)
+        if len(ids) != vecs.shape[0]:
+            raise ValueError("ids and vectors must have the same length")
+        if any("\n" in msg_id for msg_id in ids):
+            raise ValueError("ids must not contain newlines")
+        with self._lock, self._file_lock():
+            if self.dim is None:
+                self._load_meta()  # another worker may have created the store since we looked
+            if self.dim is None:
+                self.dim = vecs.shape[1]
+                tmp = f"{self.prefix}.meta.json.{os.getpid()}.tmp"
+                with open(tmp, "w") as f:
+                    json.dump({"dim": self.dim, "dtype": self.dtype}, f)
+                os.replace(tmp, self.prefix + ".meta.json")
+            if vecs.shape[1] != self.dim:
+                raise ValueError(f"expected dim {self.dim}, got {vecs.shape[1]}")
+            n = self._size(".off") // 8
+            self._trim(n)
+            if not os.path.exists(self.prefix + ".idx"):
+                self._rebuild_index(n)
+            self._refresh()
+            if n and self._probe(self._idx, self._read_id(self._off, self._ids, n - 1), n)[1] != n - 1:
+                # a writer died between publishing rows and indexing them
+                self._rebuild_index(n)
+                self._refresh()
+
+            data, scale = self._encode(vecs)
+            with open(self.prefix + ".vec", "ab") as f:
+                f.write(data)
+            if scale is not None:
+                with open(self.prefix + ".scale", "ab") as f:
+                    f.write(scale)
+            lines = [(msg_id + "\n").encode("utf-8") for msg_id in ids]
+            offsets = self._size(".ids") + np.cumsum([0] + [len(line) for line in lines[:-1]], dtype=np.int64)
+            with open(self.prefix + ".ids", "ab") as f:
+                f.write(b"".join(lines))
+            with open(self.prefix + ".stale", "ab") as f:
+                f.write(bytes(len(ids)))
+            # .off last: a row only becomes visible once its offset exists
+            with open(self.prefix + ".off", "ab") as f:
+                f.write(offsets.astype(np.int64).tobytes())
+            total = n + len(ids)
+
+            if 2 * total > self._idx.shape[0]:
+                self._rebuild_index(total)
+            else:
+                self._mapped = None
+                self._refresh()
+                idx = self._writable(".idx", np.uint64, self._idx.shape)
+                stale = self._writable(".stale", np.uint8, (total,))
+                for row, msg_id in enumerate(ids, start=n):
+                    slot, prev = self._probe(idx, msg_id, total)
+                    if prev is not None:
+                        stale[prev] = 1
+                    idx[slot] = (self._hash(msg_id), row + 1)
+                idx.flush()
+                stale.flush()
+            self._mapped = None
+            self._refresh()
+        return len(ids)
+
+    def search(self, query, k: int = 10) -> List[Tuple[str, float]]:
+        with self._lock:
+            self._refresh()
+            n, vec, scale, stale, off, ids = self._n, self._vec, self._scale, self._stale, self._off, self._ids
+        if n == 0 or k <= 0:
+            return []
+        q = _unit_rows(query)[0]
+        best_rows: List[np.ndarray] = []
+        best_scores: List[np.ndarray] = []
+        for start in range(0, n, self.SEARCH_BLOCK_ROWS):
+            end = min(start + self.SEARCH_BLOCK_ROWS, n)
+            block = vec[start:end]
+            scores = (block if block.dtype == np.float32 else block.astype(np.float32)) @ q
+            if scale is not None:
+                scores *= scale[start:end]
+            scores[stale[start:end].astype(bool)] = -np.inf
+            kk = min(k, end - start)
+            top = np.argpartition(-scores, kk - 1)[:kk]
+            best_rows.append(top + start)
+            best_scores.append(scores[top])
+        rows = np.concatenate(best_rows)
+        hits = _top_k(list(rows), np.concatenate(best_scores), k)
+        return [(self._read_id(off, ids, int(row)), score) for row, score in hits if score != -np.inf]
+
+
+# one index per guild ("default" for vectors without a guild)
+vector_indexes: Dict[str, object] = {}
+_vector_indexes_lock = threading.Lock()
+
+
+def get_vector_index(guild_id: Optional[str]):
+    """Return the guild's index: a MmapEmbeddingStore if EMBED_STORE_DIR is set, else a VectorIndex."""
+    key = re.sub(r"[^A-Za-z0-9_-]", "_", guild_id or "default")
+    with _vector_indexes_lock:
+        index = vector_indexes.get(key)
+        if index is None:
+            if EMBED_STORE_DIR:
+                os.makedirs(EMBED_STORE_DIR, exist_ok=True)
+                index = MmapEmbeddingStore(os.path.join(EMBED_STORE_DIR, key))
+            else:
+                index = VectorIndex()
+            vector_indexes[key] = index
+        return index
+
+
+class EmbedItem(BaseModel):
+    text: str
+    message_id: Optional[str] = None
+
+
+class EmbedBatchIn(BaseModel):
+    items: List[EmbedItem]
+    guild_id: Optional[str] = None
+    return_vectors: bool = True
+
+
+class SearchIn(BaseModel):
+    text: str
+    guild_id: Optional[str] = None
+    k: int = 10
+
+
+@app.post("/embed/batch")
+def embed_batch(payload: EmbedBatchIn):
+    try:
+        vectors = _embed_texts([item.text for item in payload.items])
+    except Exception as e:
+        logger.exception("Batch embedding error")
+        return {"error": str(e)}
+
+    # items that carry a message_id go into the guild's vector index
+    keyed = [(item.message_id, vec) for item, vec in zip(payload.items, vectors) if item.message_id]
+    indexed = 0
+    if keyed:
+        indexed = get_vector_index(payload.guild_id).add([k for k, _ in keyed], [v for _, v in keyed])
+
+    out = {"count": len(vectors), "indexed": indexed}
+    if payload.return_vectors:
+        out["embeddings"] = vectors
+    return out
+
+
+@app.post("/index/guild/{guild_id}")
+def index_guild_messages(guild_id: str, page_size: int = 1000):
+    """Embed the guild's stored messages into its vector index."""
+    if not supabase:
+        return {"error": "supabase not configured"}
+    index = get_vector_index(guild_id)
+    indexed, offset = 0, 0
+    while True:
+        rows = supabase.table("messages").select("message_id,content") \
+            .eq("guild_id", guild_id).order("message_id") \
+            .range(offset, offset + page_size - 1).execute().data or []
+        todo = [r for r in rows
+                if r.get("message_id") and r["message_id"] not in index and (r.get("content") or "").strip()]
+        if todo:
+            try:
+                vectors = _embed_texts([r["content"] for r in todo])
+            except Exception as e:
+                logger.exception("Index embedding error")
+                return {"error": str(e), "indexed": indexed}
+            indexed += index.add([r["message_id"] for r in todo], vectors)
+        if len(rows) < page_size:
+            break
+        offset += page_size
+    return {"indexed": indexed, "size": len(index)}
+
+
+@app.post("/search")
+def search(payload: SearchIn):
+    index = get_vector_index(payload.guild_id)
+    if len(index) == 0:
+        return {"results": []}
+    try:
+        query = cached_call("embed", GEMINI_EMBED_MODEL, payload.text, lambda: _embed_one(payload.text))
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.exception("Search embedding error")
+        return {"error": str(e)}
+    hits = index.search(query, payload.k)
+    return {"results": [{"message_id": mid, "score": score} for mid, score in hits]}
+
+# -----------------------------------------------------
+# CHAT (per-session memory) + DB
+# -----------------------------------------------------
+CHAT_CONTEXT_TOKENS = int(os.getenv("CHAT_CONTEXT_TOKENS", "1500"))  # budget for summary + recent turns
+CHAT_RECENT_TURNS = int(os.getenv("CHAT_RECENT_TURNS", "16"))  # verbatim turns kept before compaction
+CHAT_SUMMARY_BATCH = int(os.getenv("CHAT_SUMMARY_BATCH", "8"))  # old turns folded into the summary at once
+CHAT_SUMMARY_WORDS = int(os.getenv("CHAT_SUMMARY_WORDS", "150"))
+CHAT_MAX_SESSIONS = int(os.getenv("CHAT_MAX_SESSIONS", "1000"))
+
+
+class ChatIn(BaseModel):
+    text: str
+    session_id: Optional[str] = None  # omitted: a new session is started and its id returned
+
+
+def _chat_session_id(payload: ChatIn) -> str:
+    # never fall back to a shared session: that would mix different users' conversations
+    if not payload.session_id:
+        payload.session_id = uuid.uuid4().hex
+    return payload.session_id
+
+
+def _estimate_tokens(text: str) -> int:
+    # ~4 chars per token is close enough for budgeting
+    return len(text) // 4 + 1
+
+
+class ChatSession:
+    def __init__(self):
+        self.turns: deque = deque(maxlen=CHAT_RECENT_TURNS)
+        # (seq, turn) waiting to be summarized; capped in record() so a failing summarizer can't grow it
+        self.pending: deque = deque()
+        self.seq = 0
+        self.summary = ""
+        self.summarizing = False
+        self.lock = threading.Lock()
+
+
+class ChatMemory:
+    """Chat state per session: recent turns in a bounded deque plus a rolling summary.
+
+    Turns pushed out of the deque are folded into the session summary by a
+    background Gemini call every CHAT_SUMMARY_BATCH turns, so neither memory
+    nor prompt size grows with conversation length. Sessions are LRU-evicted
+    past CHAT_MAX_SESSIONS.
+    """
+
+    def __init__(self, max_sessions: int = CHAT_MAX_SESSIONS):
+        self.max_sessions = max_sessions
+        self._sessions: "OrderedDict[str, ChatSession]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._summarizer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="chat-summary")
+
+    def session(self, session_id: str) -> ChatSession:
+        with self._lock:
+            sess = self._sessions.get(session_id)
+            if sess is None:
+                sess = self._sessions[session_id] = ChatSession()
+                while len(self._sessions) > self.max_sessions:
+                    self._sessions.popitem(last=False)
+            else:
+                self._sessions.move_to_end(session_id)
+            return sess
+
+    def build_prompt(self, session_id: str, text: str) -> str:
+        sess = self.session(session_id)
+        with sess.lock:
+            summary = sess.summary
+            turns = list(sess.turns)
+
+        budget = CHAT_CONTEXT_TOKENS - _estimate_tokens(summary)
+        recent: List[str] = []
+        for role, turn_text in reversed(turns):
+            line = f"{role}: {turn_text}"
+            cost = _estimate_tokens(line)
+            if cost > budget:
+                break
+            budget -= cost
+            recent.append(line)
+        recent.reverse()
+
+        parts = []
+        if summary:
+            parts.append(f"Summary of the earlier conversation:\n{summary}")
+        if recent:
+            parts.append("Context from previous messages:\n" + "\n".join(recent))
+        context = "\n\n".join(parts)
+        return f"""
+{context}
+
+User: {text}
+
+Respond concisely.
+"""
+
+    def record(self, session_id: str, text: str, reply: str):
+        sess = self.session(session_id)
+        with sess.lock:
+            for turn in (("User", text), ("Assistant", reply)):
+                if len(sess.turns) == sess.turns.maxlen:
+                    sess.seq += 1
+                    sess.pending.append((sess.seq, sess.turns.popleft()))
+                sess.turns.append(turn)
+            dropped = 0
+            while len(sess.pending) > CHAT_SUMMARY_BATCH * 4:
+                sess.pending.popleft()
+                dropped += 1
+            if dropped:
+                logger.warning("Chat summary backlog full; dropped %d unsummarized turns", dropped)
+            if len(sess.pending) >= CHAT_SUMMARY_BATCH and not sess.summarizing:
+                sess.summarizing = True
+                self._summarizer.submit(self._compact, sess)
+
+    def _compact(self, sess: ChatSession):
+        with sess.lock:
+            summary = sess.summary
+            batch = list(sess.pending)
+        transcript = "\n".join(f"{role}: {turn_text}" for _, (role, turn_text) in batch)
+        prompt = f"""
+Update the running summary of a conversation with the new messages below.
+Keep names, decisions, tasks and open questions; drop small talk.
+Answer with the updated summary only, in at most {CHAT_SUMMARY_WORDS} words.
+
+Current summary:
+{summary or "(none)"}
+
+New messages:
+{transcript}
+"""
+        try:
+            new_summary = _generate(prompt).strip()
+        except Exception as e:
+            logger.warning("Chat summary failed: %s", e)
+            new_summary = None
+        with sess.lock:
+            if new_summary:
+                sess.summary = new_summary[:CHAT_SUMMARY_WORDS * 8]
+                # drop exactly what was summarized; turns that arrived meanwhile stay queued
+                last = batch[-1][0] if batch else 0
+                while sess.pending and sess.pending[0][0] <= last:
+                    sess.pending.popleft()
+            sess.summarizing = False
+
+
+chat_memory = ChatMemory()
+
+
+@app.post("/chat")
+def chat(payload: ChatIn):
+    session_id = _chat_session_id(payload)
+    prompt = chat_memory.build_prompt(session_id, payload.text)
+    try:
+        reply = _generate(prompt)
+    except Exception as e:
+        logger.exception("Chat error")
+        reply = "Sorry, I couldn't generate a response right now."
+    else:
+        chat_memory.record(session_id, payload.text, reply)
+
+    _save_chat(payload.text, reply)
+    return {"response": reply, "session_id": session_id}
+
+
+def _save_chat(text: str, reply: str):
+    # store minimal chat history; written in the background
+    write_behind["messages"].put({
+        "user_message": text,
+        "bot_response": reply,
+        "source": "chat"
+    })
+
+
+@app.post("/chat_db")
+def chat_db(payload: ChatIn):
     # same as /chat but explicit DB save
     return chat(payload)
 
+
+@app.post("/chat/stream")
+def chat_stream(payload: ChatIn):
+    """SSE version of /chat; the full reply is remembered and saved once the stream ends."""
+    session_id = _chat_session_id(payload)
+    prompt = chat_memory.build_prompt(session_id, payload.text)
+
+    def events():
+        parts = []
+        try:
+            for text in _generate_stream(prompt):
+                parts.append(text)
+                yield _sse("token", text)
+        except Exception as e:
+            logger.exception("Chat stream error")
+            yield _sse("error", {"error": str(e), "session_id": session_id})
+            return
+        reply = "".join(parts)
+        chat_memory.record(session_id, payload.text, reply)
+        _save_chat(payload.text, reply)
+        yield _sse("done", {"response": reply, "session_id": session_id})
+
+    return _sse_response(events())
+
+# -----------------------------------------------------
+# TRANSCRIBE (job queue: local Whisper processes or HuggingFace API)
+# -----------------------------------------------------
+HF_API_KEY = os.getenv("HF_API_KEY")
+HF_WHISPER_MODEL = os.getenv("HF_WHISPER_MODEL", "https://api-inference.huggingface.co/models/openai/whisper-small")
+HF_READ_TIMEOUT = float(os.getenv("HF_READ_TIMEOUT", "120"))  # decoding a long clip takes a while
+
+WHISPER_BACKEND = os.getenv("WHISPER_BACKEND", "hf" if HF_API_KEY else "local")  # local | hf
+TRANSCRIBE_WORKERS = int(os.getenv("TRANSCRIBE_WORKERS", "2"))
+TRANSCRIBE_QUEUE_SIZE = int(os.getenv("TRANSCRIBE_QUEUE_SIZE", "8"))  # queued + running jobs
+TRANSCRIBE_JOB_TTL = int(os.getenv("TRANSCRIBE_JOB_TTL", "3600"))  # keep finished jobs this long
+LONG_AUDIO_SECONDS = float(os.getenv("LONG_AUDIO_SECONDS", "60"))  # split recordings longer than this
+TRANSCRIBE_SEGMENT_SECONDS = float(os.getenv("TRANSCRIBE_SEGMENT_SECONDS", "28"))
+TRANSCRIBE_OVERLAP_SECONDS = float(os.getenv("TRANSCRIBE_OVERLAP_SECONDS", "1"))
+TRANSCRIBE_MAX_BYTES = int(os.getenv("TRANSCRIBE_MAX_BYTES", str(200 * 1024 * 1024)))
+TRANSCRIBE_MAX_SECONDS = float(os.getenv("TRANSCRIBE_MAX_SECONDS", str(3 * 3600)))
+TRANSCRIBE_SPOOL_DIR = os.getenv("TRANSCRIBE_SPOOL_DIR") or tempfile.gettempdir()
+UPLOAD_CHUNK_BYTES = 1024 * 1024
+
+
+def _hf_transcribe(path: str) -> dict:
+    headers = {"Authorization": f"Bearer {HF_API_KEY}"}
+    # a file object is streamed by requests rather than read into memory
+    with open(path, "rb") as audio_file:
+        res = http_pool.post(HF_WHISPER_MODEL, headers=headers, data=audio_file,
+                             timeout=(HTTP_CONNECT_TIMEOUT, HF_READ_TIMEOUT))
+    try:
+        text = res.json().get("text")
+    except:
+        text = None
+    return {"text": text}
+
+
+class QueueFull(Exception):
+    pass
+
+
+class TranscriptionJobs:
+    """Bounded transcription job queue.
+
+    Local Whisper runs in a pool of spawned processes, each loading its own
+    model, so a long decode never holds the GIL or the event loop of the web
+    worker. A local job is coordinated from a thread: the audio is decoded to
+    16 kHz mono float32, recordings over LONG_AUDIO_SECONDS are split on
+    silence into overlapping segments, the segments are transcribed in
+    parallel across the pool and stitched back on one timeline. The HF backend
+    is plain network I/O and runs on threads instead. At most ``queue_size``
+    jobs may be queued or running; past that ``submit`` raises QueueFull and
+    the routes answer 429.
+    """
+
+    def __init__(self, backend: str = WHISPER_BACKEND, workers: int = TRANSCRIBE_WORKERS,
+                 queue_size: int = TRANSCRIBE_QUEUE_SIZE):
+        self.backend = backend
+        self.workers = max(1, workers)
+        self.queue_size = max(1, queue_size)
+        self._slots = threading.BoundedSemaphore(self.queue_size)
+        self._pool = None
+        self._jobs_executor = None
+        self._lock = threading.Lock()
+        self._jobs: Dict[str, dict] = {}
+
+    def _get_pool(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=transcribe_worker.init_worker,
+                    initargs=(WHISPER_MODEL,),
+                )
+            return self._pool
+
+    def warm(self):
+        """Start the worker processes and wait until each has loaded its model."""
+        if self.backend != "local":
+            return self.backend
+        pool = self._get_pool()
+        # each submit spawns one more worker until the pool is full
+        loaded = [f.result() for f in [pool.submit(transcribe_worker.is_ready) for _ in range(self.workers)]]
+        if not all(loaded):
+            raise RuntimeError("Whisper model not available")
+        return pool
+
+    def _get_jobs_executor(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._jobs_executor is None:
+                size = self.queue_size if self.backend == "local" else self.workers
+                self._jobs_executor = ThreadPoolExecutor(max_workers=size, thread_name_prefix="transcribe")
+            return self._jobs_executor
+
+    def _transcribe_local(self, path: str) -> dict:
+        # decoding happens inside the pool too: the web process never holds samples
+        pool = self._get_pool()
+        pcm_path = path + ".pcm"
+        try:
+            n, plan = pool.submit(
+                transcribe_worker.prepare, path, pcm_path, TRANSCRIBE_MAX_SECONDS,
+                LONG_AUDIO_SECONDS, TRANSCRIBE_SEGMENT_SECONDS, TRANSCRIBE_OVERLAP_SECONDS,
+            ).result()
+            sr = transcribe_worker.SAMPLE_RATE
+            futures = []
+            for i, (start, stop, core_start, core_stop) in enumerate(plan):
+                futures.append(pool.submit(
+                    transcribe_worker.transcribe_pcm, pcm_path, n, start, stop,
+                    core_start / sr if i > 0 else None,
+                    core_stop / sr if i < len(plan) - 1 else None,
+                ))
+            segments = [piece for fut in futures for piece in fut.result()]
+        finally:
+            _remove_quietly(pcm_path)
+        return {
+            "text": " ".join(piece["text"] for piece in segments),
+            "segments": segments,
+            "duration": round(n / sr, 2),
+        }
+
+    def submit(self, path: str, on_done: Optional[Callable[[dict], None]] = None) -> str:
+        """Queue the audio file at ``path``; the job owns the file and deletes it when done."""
+        if not self._slots.acquire(blocking=False):
+            raise QueueFull()
+        self._prune()
+        fn = self._transcribe_local if self.backend == "local" else _hf_transcribe
+        try:
+            fut = self._get_jobs_executor().submit(fn, path)
+        except Exception:
+            self._slots.release()
+            raise
+        job_id = uuid.uuid4().hex
+        job = {"id": job_id, "created": time.time(), "finished": None, "future": fut}
+        with self._lock:
+            self._jobs[job_id] = job
+
+        def _finish(done: Future):
+            self._slots.release()
+            _remove_quietly(path)
+            job["finished"] = time.time()
+            if on_done is not None and done.exception() is None:
+                try:
+                    on_done(done.result())
+                except Exception as e:
+                    logger.warning("Transcription callback failed for %s: %s", job_id, e)
+
+        fut.add_done_callback(_finish)
+        return job_id
+
+    def future(self, job_id: str) -> Optional[Future]:
+        job = self._jobs.get(job_id)
+        return job["future"] if job else None
+
+    def status(self, job_id: str) -> Optional[dict]:
+        job = self._jobs.get(job_id)
+        if job is None:
+            return None
+        fut = job["future"]
+        out = {"job_id": job_id, "created": job["created"], "finished": job["finished"]}
+        if not fut.done():
+            out["status"] = "running" if fut.running() else "queued"
+        elif fut.exception() is not None:
+            out["status"] = "error"
+            out["error"] = str(fut.exception())
+        else:
+            out["status"] = "done"
+        return out
+
+    def _prune(self):
+        cutoff = time.time() - TRANSCRIBE_JOB_TTL
+        with self._lock:
+            for job_id in [j for j, job in self._jobs.items() if job["finished"] and job["finished"] < cutoff]:
+                del self._jobs[job_id]
+
+
+transcription_jobs = TranscriptionJobs()
+registry.register("whisper", transcription_jobs.warm)
+
+
+def _store_transcript(result: dict):
+    text = result.get("text")
+    if text:
+        write_behind["audio_transcripts"].put({"transcript": text})
+
+
+def _remove_quietly(path: str):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+async def _spool_upload(file: UploadFile) -> str:
+    """Copy the upload to a temp file chunk by chunk, enforcing TRANSCRIBE_MAX_BYTES."""
+    suffix = os.path.splitext(file.filename or "")[1]
+    fd, path = tempfile.mkstemp(prefix="upload-", suffix=suffix, dir=TRANSCRIBE_SPOOL_DIR)
+    size = 0
+    try:
+        with os.fdopen(fd, "wb") as out:
+            while True:
+                chunk = await file.read(UPLOAD_CHUNK_BYTES)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > TRANSCRIBE_MAX_BYTES:
+                    raise HTTPException(status_code=413, detail=f"Audio larger than {TRANSCRIBE_MAX_BYTES} bytes")
+                out.write(chunk)
+    except BaseException:
+        _remove_quietly(path)
+        raise
+    return path
+
+
+def _check_audio(path: str):
+    """Reject undecodable or over-long audio from its header before queueing it."""
+    try:
+        info = sf.info(path)
+    except Exception as e:
+        if WHISPER_BACKEND == "local":
+            raise HTTPException(status_code=400, detail=f"Unsupported audio: {e}")
+        return  # the HF endpoint decodes more formats than libsndfile
+    if info.duration > TRANSCRIBE_MAX_SECONDS:
+        raise HTTPException(status_code=413, detail=f"Audio longer than {TRANSCRIBE_MAX_SECONDS:.0f}s")
+
+
+async def _submit_upload(file: UploadFile, store: bool) -> str:
+    path = await _spool_upload(file)
+    try:
+        _check_audio(path)
+        return transcription_jobs.submit(path, on_done=_store_transcript if store else None)
+    except QueueFull:
+        _remove_quietly(path)
+        raise HTTPException(status_code=429, detail="Transcription queue is full, retry later")
+    except BaseException:
+        _remove_quietly(path)
+        raise
+
+
+@app.post("/transcribe/jobs", status_code=202)
+async def create_transcription_job(file: UploadFile = File(...), store: bool = False):
+    job_id = await _submit_upload(file, store)
+    return {"job_id": job_id, "status": "queued"}
+
+
+@app.get("/transcribe/jobs/{job_id}")
+def transcription_job_status(job_id: str):
+    status = transcription_jobs.status(job_id)
+    if status is None:
+        raise HTTPException(status_code=404, detail="Unknown job")
+    return status
+
+
+@app.get("/transcribe/jobs/{job_id}/result")
+def transcription_job_result(job_id: str):
+    status = transcription_jobs.status(job_id)
+    if status is None:
+        raise HTTPException(status_code=404, detail="Unknown job")
+    if status["status"] == "error":
+        return {"error": status["error"]}
+    if status["status"] != "done":
+        raise HTTPException(status_code=409, detail=f"Job is {status['status']}")
+    return transcription_jobs.future(job_id).result()
+
+
+@app.post("/transcribe")
+async def transcribe_audio(file: UploadFile = File(...)):
+    job_id = await _submit_upload(file, store=False)
+    try:
+        return await asyncio.wrap_future(transcription_jobs.future(job_id))
+    except Exception as e:
+        logger.warning("Transcription failed: %s", e)
+        return {"error": str(e)}
+
+
+@app.post("/transcribe_upload")
+async def transcribe_and_store(file: UploadFile = File(...)):
+    job_id = await _submit_upload(file, store=True)
+    try:
+        result = await asyncio.wrap_future(transcription_jobs.future(job_id))
+    except Exception as e:
+        logger.warning("Transcription failed: %s", e)
+        return {"error": str(e)}
+    return {"text": result.get("text"), "status": "stored in db"}
+
+# -----------------------------------------------------
+# DISCORD API CLIENT (bot token, rate-limit aware)
+# -----------------------------------------------------
+DISCORD_API = "https://discord.com/api/v10"
+DISCORD_MAX_CONCURRENCY = int(os.getenv("DISCORD_MAX_CONCURRENCY", "8"))
+DISCORD_MAX_RETRIES = int(os.getenv("DISCORD_MAX_RETRIES", "5"))
+
+# ids after these path segments are "major parameters": they get their own buckets
+_MAJOR_PARAMS = ("channels", "guilds", "webhooks")
+
+
+class DiscordClient:
+    """Shared bot client that runs requests concurrently without getting throttled.
+
+    Every request is keyed to a route (method + path with minor ids folded);
+    Discord's X-RateLimit-Bucket / -Remaining / -Reset-After headers map routes
+    to buckets and tell us when a bucket is empty, in which case callers wait
+    for its reset instead of firing. A 429 parks the bucket (or, for a global
+    limit, every request) for ``retry_after`` and the request is retried; 5xx
+    responses back off exponentially. At most ``max_concurrency`` requests are
+    in flight at once, and ``map`` fans work out over a pool of that size.
+    """
+
+    def __init__(self, token: Optional[str], max_concurrency: int = DISCORD_MAX_CONCURRENCY,
+                 max_retries: int = DISCORD_MAX_RETRIES):
+        self.token = token
+        self.max_retries = max(1, max_retries)
+        self.max_concurrency = max(1, max_concurrency)
+        self._slots = threading.BoundedSemaphore(self.max_concurrency)
+        self._aslots: Optional[asyncio.Semaphore] = None
+        self._executor = ThreadPoolExecutor(max_workers=max(1, max_concurrency), thread_name_prefix="discord")
+        self._lock = threading.Lock()
+        self._route_buckets: Dict[str, str] = {}
+        self._buckets: Dict[str, Dict[str, float]] = {}
+        self._global_until = 0.0
+
+    @staticmethod
+    def _route_key(method: str, path: str) -> str:
+        parts = path.split("?", 1)[0].strip("/").split("/")
+        for i, part in enumerate(parts):
+            if part.isdigit() and not (i > 0 and parts[i - 1] in _MAJOR_PARAMS):
+                parts[i] = "{id}"
+        return method.upper() + " /" + "/".join(parts)
+
+    def _bucket_key(self, route: str) -> str:
+        # routes sharing a bucket hash still get separate limits per major parameter
+        bucket_id = self._route_buckets.get(route)
+        if not bucket_id:
+            return route
+        return bucket_id + ":" + ":".join(p for p in route.split("/") if p.isdigit())
+
+    def _reserve(self, route: str) -> float:
+        """Take a slot in the route's bucket; returns seconds to wait first (0 = go)."""
+        with self._lock:
+            now = time.monotonic()
+            wait = self._global_until - now
+            key = self._bucket_key(route)
+            bucket = self._buckets.get(key)
+            if wait <= 0 and bucket is not None:
+                if bucket["reset_at"] <= now:
+                    # the window rolled over: let one request through to learn the new
+                    # limit and hold the rest until its headers come back
+                    self._buckets[key] = {"remaining": 0, "reset_at": now + 1.0}
+                elif bucket["remaining"] > 0:
+                    bucket["remaining"] -= 1
+                else:
+                    wait = bucket["reset_at"] - now
+            return max(0.0, wait)
+
+    def _wait_for_capacity(self, route: str):
+        while True:
+            wait = self._reserve(route)
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+    async def _await_capacity(self, route: str):
+        while True:
+            wait = self._reserve(route)
+            if wait <= 0:
+                return
+            await asyncio.sleep(wait)
+
+    def _update_limits(self, route: str, res):
+        # works for both requests and httpx responses
+        headers = res.headers
+        with self._lock:
+            bucket_id = headers.get("X-RateLimit-Bucket")
+            if bucket_id:
+                self._route_buckets[route] = bucket_id
+            key = self._bucket_key(route)
+            remaining = headers.get("X-RateLimit-Remaining")
+            reset_after = headers.get("X-RateLimit-Reset-After")
+            if remaining is not None and reset_after is not None:
+                self._buckets[key] = {
+                    "remaining": int(remaining),
+                    "reset_at": time.monotonic() + float(reset_after),
+                }
+            if res.status_code == 429:
+                try:
+                    body = res.json()
+                except Exception:
+                    body = {}
+                retry_after = float(body.get("retry_after") or headers.get("Retry-After") or 1.0)
+                if body.get("global") or headers.get("X-RateLimit-Global"):
+                    self._global_until = time.monotonic() + retry_after
+                else:
+                    self._buckets[key] = {"remaining": 0, "reset_at": time.monotonic() + retry_after}
+                logger.warning("Discord 429 on %s; retrying in %.2fs", route, retry_after)
+
+    def request(self, method: str, path: str, **kwargs) -> requests.Response:
+        route = self._route_key(method, path)
+        headers = {"Authorization": f"Bot {self.token}"}
+        headers.update(kwargs.pop("headers", {}) or {})
+        res = None
+        for attempt in range(self.max_retries):
+            self._wait_for_capacity(route)
+            with self._slots:
+                res = http_pool.request(method, DISCORD_API + path, headers=headers, **kwargs)
+            self._update_limits(route, res)
+            if res.status_code == 429:
+                continue
+            if res.status_code >= 500 and attempt + 1 < self.max_retries:
+                time.sleep(min(30.0, 0.5 * (2 ** attempt)))
+                continue
+            return res
+        return res
+
+    def get(self, path: str, **params):
+        """GET and decode JSON (errors come back as Discord's error objects)."""
+        return self.request("GET", path, params=params or None).json()
+
+    async def arequest(self, method: str, path: str, **kwargs):
+        """Async twin of ``request`` on the shared httpx client (ASYNC_IO mode)."""
+        route = self._route_key(method, path)
+        headers = {"Authorization": f"Bot {self.token}"}
+        headers.update(kwargs.pop("headers", {}) or {})
+        if self._aslots is None:
+            self._aslots = asyncio.Semaphore(self.max_concurrency)
+        res = None
+        for attempt in range(self.max_retries):
+            await self._await_capacity(route)
+            async with self._aslots:
+                res = await async_http().request(method, DISCORD_API + path, headers=headers, **kwargs)
+            self._update_limits(route, res)
+            if res.status_code == 429:
+                continue
+            if res.status_code >= 500 and attempt + 1 < self.max_retries:
+                await asyncio.sleep(min(30.0, 0.5 * (2 ** attempt)))
+                continue
+            return res
+        return res
+
+    async def aget(self, path: str, **params):
+        return (await self.arequest("GET", path, params=params or None)).json()
+
+    def map(self, fn: Callable, items) -> list:
+        """Run ``fn`` over ``items`` on the client's pool; results keep input order."""
+        return list(self._executor.map(fn, items))
+
+
+discord = DiscordClient(DISCORD_BOT_TOKEN)
+
 # -----------------------------------------------------
-# TRANSCRIBE (HuggingFace Whisper-small API) + upload
+# DISCORD METADATA CACHE (per-kind TTL + single-flight)
 # -----------------------------------------------------
-HF_API_KEY = os.getenv("HF_API_KEY")
-HF_WHISPER_MODEL = os.getenv("HF_WHISPER_MODEL", "https://api-inference.huggingface.co/models/openai/whisper-small")
+META_TTLS = {
+    "bot_user": float(os.getenv("META_TTL_BOT_USER", "3600")),
+    "bot_guilds": float(os.getenv("META_TTL_BOT_GUILDS", "300")),
+    "guild": float(os.getenv("META_TTL_GUILD", "600")),  # owner + roles
+    "guild_channels": float(os.getenv("META_TTL_GUILD_CHANNELS", "300")),
+    "guild_member": float(os.getenv("META_TTL_GUILD_MEMBER", "600")),
+}
 
-@app.post("/transcribe")
-async def transcribe_audio(file: UploadFile = File(...)):
-    audio_bytes = await file.read()
-    headers = {"Authorization": f"Bearer {HF_API_KEY}"}
-    res = requests.post(HF_WHISPER_MODEL, headers=headers, data=audio_bytes)
+
+class MetadataCache:
+    """TTL cache for slow-changing Discord metadata.
+
+    A miss is loaded through SingleFlight so a burst of callers costs one API
+    request. Error bodies are never cached. Entries are dropped early when
+    /discord/events reports a change.
+    """
+
+    def __init__(self, ttls: Dict[str, float] = META_TTLS):
+        self.ttls = ttls
+        self._entries: Dict[Tuple[str, str], Tuple[float, object]] = {}
+        self._lock = threading.Lock()
+        self._flight = SingleFlight()
+        self.stats = {"hits": 0, "misses": 0, "invalidations": 0}
+
+    def peek(self, kind: str, key: str):
+        entry = self._entries.get((kind, key))
+        if entry is not None and entry[0] > time.monotonic():
+            self.stats["hits"] += 1
+            return entry[1]
+        return None
+
+    def put(self, kind: str, key: str, value):
+        with self._lock:
+            self._entries[(kind, key)] = (time.monotonic() + self.ttls.get(kind, 300), value)
+
+    def get(self, kind: str, key: str, loader: Callable[[], object], ok: Callable[[object], bool]):
+        value = self.peek(kind, key)
+        if value is not None:
+            return value
+
+        def load():
+            self.stats["misses"] += 1
+            fresh = loader()
+            if ok(fresh):
+                self.put(kind, key, fresh)
+            return fresh
+
+        return self._flight.do((kind, key), load)
+
+    def invalidate(self, kind: str, key: Optional[str] = None):
+        with self._lock:
+            for k in [k for k in self._entries if k[0] == kind and (key is None or k[1] == key)]:
+                del self._entries[k]
+                self.stats["invalidations"] += 1
+
+
+meta_cache = MetadataCache()
+
+
+def _is_list(value) -> bool:
+    return isinstance(value, list)
+
+
+def _has_id(value) -> bool:
+    return isinstance(value, dict) and "id" in value
+
+
+def _bot_user():
+    return meta_cache.get("bot_user", "@me", lambda: discord.get("/users/@me"), _has_id)
+
+
+def _bot_guilds():
+    return meta_cache.get("bot_guilds", "@me", lambda: discord.get("/users/@me/guilds"), _is_list)
+
+
+def _guild(guild_id: str):
+    return meta_cache.get("guild", guild_id, lambda: discord.get(f"/guilds/{guild_id}"), _has_id)
+
+
+def _guild_channels(guild_id: str):
+    return meta_cache.get("guild_channels", guild_id, lambda: discord.get(f"/guilds/{guild_id}/channels"), _is_list)
+
+
+def _guild_member(guild_id: str, user_id: str):
+    return meta_cache.get("guild_member", f"{guild_id}:{user_id}",
+                          lambda: discord.get(f"/guilds/{guild_id}/members/{user_id}"),
+                          lambda v: isinstance(v, dict) and "roles" in v)
+
+
+def _invalidate_for_event(payload: dict):
+    """Drop cached metadata touched by a gateway-style event ({"t": ..., "d": {...}})."""
+    event = payload.get("t") or payload.get("type") or payload.get("event")
+    data = payload.get("d") or payload.get("data") or {}
+    if not isinstance(event, str) or not isinstance(data, dict):
+        return
+    guild_id = data.get("guild_id")
+    if event.startswith("CHANNEL_") or event.startswith("THREAD_"):
+        if guild_id:
+            meta_cache.invalidate("guild_channels", guild_id)
+    elif event.startswith("GUILD_ROLE_"):
+        if guild_id:
+            meta_cache.invalidate("guild", guild_id)
+    elif event == "GUILD_MEMBER_UPDATE":
+        user_id = (data.get("user") or {}).get("id")
+        if guild_id and user_id:
+            meta_cache.invalidate("guild_member", f"{guild_id}:{user_id}")
+    elif event in ("GUILD_CREATE", "GUILD_UPDATE", "GUILD_DELETE"):
+        guild_id = data.get("id") or guild_id
+        meta_cache.invalidate("bot_guilds")
+        if guild_id:
+            meta_cache.invalidate("guild", guild_id)
+            meta_cache.invalidate("guild_channels", guild_id)
+
+
+@app.get("/discord/cache/stats")
+def discord_cache_stats():
+    return dict(meta_cache.stats, entries=len(meta_cache._entries))
+
+
+# -----------------------------------------------------
+# DISCORD OAUTH + BOT FLOW
+# -----------------------------------------------------
+
+# discord oauth url for user login
+DISCORD_OAUTH_URL = (
+    "https://discord.com/api/oauth2/authorize"
+    f"?client_id={DISCORD_CLIENT_ID}"
+    "&response_type=code"
+    "&scope=identify%20guilds"
+    f"&redirect_uri={DISCORD_REDIRECT_URI}"
+)
+
+@app.get("/discord/login")
+def discord_login():
+    return RedirectResponse(DISCORD_OAUTH_URL)
+
+
+@app.get("/oauth/discord/callback")
+def discord_callback(code: str):
+    # exchange code for user token
+    token_res = http_pool.post(
+        "https://discord.com/api/oauth2/token",
+        data={
+            "client_id": DISCORD_CLIENT_ID,
+            "client_secret": DISCORD_CLIENT_SECRET,
+            "grant_type": "authorization_code",
+            "code": code,
+            "redirect_uri": DISCORD_REDIRECT_URI,
+        },
+        headers={"Content-Type": "application/x-www-form-urlencoded"}
+    ).json()
+
+    access_token = token_res.get("access_token")
+    if not access_token:
+        logger.error("No access_token in token_res: %s", token_res)
+        return RedirectResponse("/discord/no_admin_guild")
+
+    # fetch user's guilds
+    guilds = http_pool.get(
+        "https://discord.com/api/v10/users/@me/guilds",
+        headers={"Authorization": f"Bearer {access_token}"}
+    ).json()
+
+    # Option B: select guilds where user has ADMIN permission
+    admin_guilds = [g for g in (guilds or []) if (int(g.get("permissions", 0)) & 0x8) != 0]
+    if not admin_guilds:
+        return RedirectResponse("/discord/no_admin_guild")
+
+    selected = admin_guilds[0]
+    selected_guild_id = selected.get("id")
+
+    # save user info + selected guild
+    if supabase:
+        try:
+            supabase.table("discord_users").insert({
+                "user_access_token": access_token,
+                "guilds": guilds,
+                "selected_guild": selected_guild_id
+            }).execute()
+        except Exception as e:
+            logger.warning("Failed to save discord_user: %s", e)
+
+    # redirect to bot invite (preselect guild)
+    bot_auth_url = (
+        "https://discord.com/api/oauth2/authorize"
+        f"?client_id={DISCORD_CLIENT_ID}"
+        "&scope=bot%20applications.commands"
+        f"&guild_id={selected_guild_id}"
+        "&permissions=8"
+        f"&redirect_uri={DISCORD_REDIRECT_URI}"
+    )
+    return RedirectResponse(bot_auth_url)
+
+
+@app.get("/discord/guild/{guild_id}/authorize_bot")
+def authorize_bot(guild_id: str):
+    bot_oauth = (
+        "https://discord.com/api/oauth2/authorize"
+        f"?client_id={DISCORD_CLIENT_ID}"
+        "&scope=bot%20applications.commands"
+        f"&guild_id={guild_id}"
+        "&permissions=8"
+        f"&redirect_uri={DISCORD_REDIRECT_URI}"
+    )
+    return RedirectResponse(bot_oauth)
+
+
+@app.get("/discord/guild/{guild_id}/channels")
+def list_guild_channels(guild_id: str):
     try:
-        text = res.json().get("text")
-    except:
-        text = None
-    return {"text": text}
+        channels = _guild_channels(guild_id)
+    except Exception as e:
+        logger.warning("List channels json error: %s", e)
+        return {"error": str(e)}
+    return {"channels": channels}
 
-@app.post("/transcribe_upload")
-async def transcribe_and_store(file: UploadFile = File(...)):
-    audio_bytes = await file.read()
-    headers = {"Authorization": f"Bearer {HF_API_KEY}"}
-    res = requests.post(HF_WHISPER_MODEL, headers=headers, data=audio_bytes)
+
+# -----------------------------------------------------
+# BOT PERMISSIONS (computed locally, Discord-style)
+# -----------------------------------------------------
+PERM_ADMINISTRATOR = 1 << 3
+PERM_VIEW_CHANNEL = 1 << 10
+PERM_READ_MESSAGE_HISTORY = 1 << 16
+PERM_ALL = (1 << 64) - 1
+
+_THREAD_TYPES = (10, 11, 12)
+
+
+def _base_permissions(guild: dict, member: dict, user_id: str) -> int:
+    if str(guild.get("owner_id")) == str(user_id):
+        return PERM_ALL
+    roles = {r["id"]: int(r.get("permissions", 0)) for r in guild.get("roles", []) if isinstance(r, dict)}
+    perms = roles.get(guild["id"], 0)  # @everyone shares the guild's id
+    for role_id in member.get("roles", []):
+        perms |= roles.get(role_id, 0)
+    if perms & PERM_ADMINISTRATOR:
+        return PERM_ALL
+    return perms
+
+
+def _overwrite_permissions(base: int, overwrites: List[dict], guild_id: str, role_ids: List[str], user_id: str) -> int:
+    """Apply @everyone, then role, then member overwrites in Discord's order."""
+    if base & PERM_ADMINISTRATOR or base == PERM_ALL:
+        return PERM_ALL
+    by_id = {o.get("id"): o for o in overwrites or [] if isinstance(o, dict)}
+    perms = base
+    everyone = by_id.get(guild_id)
+    if everyone:
+        perms = (perms & ~int(everyone.get("deny", 0))) | int(everyone.get("allow", 0))
+    allow = deny = 0
+    for role_id in role_ids:
+        o = by_id.get(role_id)
+        if o:
+            allow |= int(o.get("allow", 0))
+            deny |= int(o.get("deny", 0))
+    perms = (perms & ~deny) | allow
+    member = by_id.get(user_id)
+    if member:
+        perms = (perms & ~int(member.get("deny", 0))) | int(member.get("allow", 0))
+    return perms
+
+
+def _bot_channel_permissions(guild_id: str, channels: Optional[List[dict]] = None) -> Optional[Dict[str, dict]]:
+    """Per-channel VIEW / READ_HISTORY verdicts for the bot from cached metadata.
+
+    Returns None when the guild, the bot member or the channel list can't be
+    fetched (e.g. the bot isn't in the guild), so callers can fall back.
+    """
+    me = _bot_user()
+    if not isinstance(me, dict) or not me.get("id"):
+        logger.warning("Could not fetch bot user: %s", me)
+        return None
+    user_id = me["id"]
+    loaders = [lambda: _guild(guild_id), lambda: _guild_member(guild_id, user_id)]
+    if channels is None:
+        loaders.append(lambda: _guild_channels(guild_id))
+    fetched = discord.map(lambda load: load(), loaders)
+    guild, member = fetched[0], fetched[1]
+    if channels is None:
+        channels = fetched[2]
+    if not isinstance(guild, dict) or "roles" not in guild or not isinstance(member, dict) or "roles" not in member \
+            or not isinstance(channels, list):
+        logger.warning("Could not compute permissions for guild %s", guild_id)
+        return None
+
+    base = _base_permissions(guild, member, user_id)
+    by_id = {ch.get("id"): ch for ch in channels if isinstance(ch, dict)}
+    verdicts = {}
+    for ch_id, ch in by_id.items():
+        # threads take their parent channel's permissions
+        source = by_id.get(ch.get("parent_id"), ch) if ch.get("type") in _THREAD_TYPES else ch
+        perms = _overwrite_permissions(base, source.get("permission_overwrites"), guild_id, member["roles"], user_id)
+        view = bool(perms & PERM_VIEW_CHANNEL)
+        verdicts[ch_id] = {
+            "view": view,
+            "read_history": view and bool(perms & PERM_READ_MESSAGE_HISTORY),
+            "permissions": str(perms),
+        }
+    return verdicts
+
+
+@app.get("/discord/permissions/{guild_id}")
+def permissions_check(guild_id: str):
+    """Return a per-channel permission check for the bot."""
+    channels = _guild_channels(guild_id)
+    if not isinstance(channels, list):
+        return {"error": channels}
+    verdicts = _bot_channel_permissions(guild_id, channels)
+    if verdicts is None:
+        return {"error": "could not fetch guild, roles or bot member"}
+    report = [
+        {"channel": ch.get("name"), "id": ch.get("id"), "type": ch.get("type"), **verdicts[ch.get("id")]}
+        for ch in channels if isinstance(ch, dict)
+    ]
+    return {"report": report}
+
+
+# -----------------------------------------------------
+# RAW PAYLOAD STORAGE (compact projection + optional raw)
+# -----------------------------------------------------
+# full    - legacy rows: the whole Discord object in messages.raw / discord_events.event
+# none    - typed projection only, raw payload dropped
+# gzip    - projection + raw_blob = "gzip:<base64>"
+# zstd    - projection + raw_blob = "zstd:<base64>" (falls back to gzip without zstandard)
+# archive - projection + raw_blob = "archive:<path>:<offset>:<length>", gzip records
+#           appended to RAW_ARCHIVE_PATH on this host
+# Non-full modes need these columns (discord_events: event_type, guild_id, channel_id,
+# message_id, raw_blob):
+#   author_bot bool, created_at timestamptz, edited_at timestamptz, message_type int,
+#   reply_to text, mention_count int, attachment_count int, embed_count int,
+#   reaction_count int, pinned bool, raw_blob text
+RAW_MODES = ("full", "none", "gzip", "zstd", "archive")
+RAW_MODE = os.getenv("RAW_MODE", "full").lower()
+if RAW_MODE not in RAW_MODES:
+    # refuse to start: a typo would otherwise write projection columns the table may not have
+    raise ValueError(f"RAW_MODE must be one of {', '.join(RAW_MODES)}; got {RAW_MODE!r}")
+RAW_ARCHIVE_PATH = os.getenv("RAW_ARCHIVE_PATH", os.path.join(tempfile.gettempdir(), "discord_raw.archive"))
+RAW_ZSTD_LEVEL = int(os.getenv("RAW_ZSTD_LEVEL", "10"))
+
+_raw_lock = threading.Lock()
+_zstd = None  # zstandard module, imported on first use
+raw_stats = {"rows": 0, "raw_bytes": 0, "stored_bytes": 0}
+
+
+def _zstd_module():
+    global _zstd
+    if _zstd is None:
+        try:
+            import zstandard
+            _zstd = zstandard
+        except ImportError:
+            logger.warning("RAW_MODE=zstd but zstandard is not installed; using gzip")
+            _zstd = False
+    return _zstd
+
+
+def _encode_raw(data: bytes) -> Optional[str]:
+    """Return the raw_blob for a payload's compact JSON under RAW_MODE (None when raw is dropped)."""
+    if RAW_MODE == "none":
+        return None
+    if RAW_MODE == "zstd" and _zstd_module():
+        return "zstd:" + base64.b64encode(_zstd.ZstdCompressor(level=RAW_ZSTD_LEVEL).compress(data)).decode("ascii")
+    packed = gzip.compress(data, compresslevel=6)
+    if RAW_MODE != "archive":
+        return "gzip:" + base64.b64encode(packed).decode("ascii")
+    # exclusive flock: every worker on the host appends to the same file
+    with _raw_lock, open(RAW_ARCHIVE_PATH, "ab") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            offset = f.seek(0, os.SEEK_END)
+            f.write(packed)
+            f.flush()
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+    return f"archive:{RAW_ARCHIVE_PATH}:{offset}:{len(packed)}"
+
+
+def _decode_raw(blob: str):
+    """Inverse of ``_encode_raw``."""
+    kind, _, rest = blob.partition(":")
+    if kind == "gzip":
+        return json.loads(gzip.decompress(base64.b64decode(rest)))
+    if kind == "zstd":
+        if not _zstd_module():
+            raise RuntimeError("zstandard is required to read this payload")
+        return json.loads(_zstd.ZstdDecompressor().decompress(base64.b64decode(rest)))
+    if kind == "archive":
+        path, offset, length = rest.rsplit(":", 2)
+        with open(path, "rb") as f:
+            f.seek(int(offset))
+            return json.loads(gzip.decompress(f.read(int(length))))
+    raise ValueError(f"unknown raw_blob kind: {kind}")
+
+
+def _with_raw(row: dict, payload, raw_key: str) -> dict:
+    """Attach the payload to ``row`` as RAW_MODE says and count the bytes saved."""
+    if RAW_MODE == "full":
+        row[raw_key] = payload
+        return row
+    # serialized once: the same bytes are compressed and measured
+    data = json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    blob = _encode_raw(data)
+    raw_bytes = len(data)
+    stored_bytes = len(json.dumps(row, ensure_ascii=False, separators=(",", ":")).encode("utf-8"))
+    if blob is not None:
+        row["raw_blob"] = blob
+        stored_bytes += len(blob) + len(',"raw_blob":""')  # base64/ascii needs no escaping
+    with _raw_lock:
+        raw_stats["rows"] += 1
+        raw_stats["raw_bytes"] += raw_bytes
+        raw_stats["stored_bytes"] += stored_bytes
+    return row
+
+
+def _event_row(payload: dict) -> dict:
+    if RAW_MODE == "full":
+        return {"event": payload}
+    data = payload.get("d") or payload.get("data") or {}
+    data = data if isinstance(data, dict) else {}
+    row = {
+        "event_type": payload.get("t") or payload.get("type") or payload.get("event"),
+        "guild_id": data.get("guild_id"),
+        "channel_id": data.get("channel_id"),
+        "message_id": data.get("message_id") or (data.get("id") if "content" in data else None),
+    }
+    return _with_raw(row, payload, "event")
+
+
+@app.get("/raw/stats")
+def raw_payload_stats():
+    saved = raw_stats["raw_bytes"] - raw_stats["stored_bytes"]
+    return dict(raw_stats, mode=RAW_MODE, bytes_saved=saved)
+
+
+@app.get("/discord/messages/{message_id}/raw")
+def message_raw(message_id: str):
+    """The original Discord object for a stored message, whatever RAW_MODE it was written with."""
+    if not supabase:
+        return {"error": "supabase not configured"}
     try:
-        text = res.json().get("text")
-    except:
-        text = None
+        columns = "raw" if RAW_MODE == "full" else "raw,raw_blob"
+        rows = supabase.table("messages").select(columns).eq("message_id", message_id).limit(1).execute().data
+    except Exception as e:
+        logger.warning("Could not read raw message %s: %s", message_id, e)
+        return {"error": str(e)}
+    if not rows:
+        raise HTTPException(status_code=404, detail="message not found")
+    row = rows[0]
+    if row.get("raw_blob"):
+        try:
+            return {"raw": _decode_raw(row["raw_blob"])}
+        except Exception as e:
+            logger.warning("Could not decode raw message %s: %s", message_id, e)
+            return {"error": str(e)}
+    return {"raw": row.get("raw")}
+
+# -----------------------------------------------------
+# SYNC HELPERS (bulk upsert on message_id)
+# -----------------------------------------------------
+
+def _message_projection(msg: dict) -> dict:
+    return {
+        "author_bot": bool((msg.get("author") or {}).get("bot")),
+        "created_at": msg.get("timestamp"),
+        "edited_at": msg.get("edited_timestamp"),
+        "message_type": msg.get("type"),
+        "reply_to": (msg.get("message_reference") or {}).get("message_id"),
+        "mention_count": len(msg.get("mentions") or []),
+        "attachment_count": len(msg.get("attachments") or []),
+        "embed_count": len(msg.get("embeds") or []),
+        "reaction_count": sum(r.get("count", 0) for r in msg.get("reactions") or []),
+        "pinned": bool(msg.get("pinned")),
+    }
+
+
+def _message_row(guild_id: str, msg: dict) -> dict:
+    author = msg.get("author", {}) or {}
+    row = {
+        "source": "discord",
+        "guild_id": guild_id,
+        "channel_id": msg.get("channel_id"),
+        "channel_name": msg.get("channel_name"),
+        "author_id": author.get("id"),
+        "author_username": author.get("username"),
+        "message_id": msg.get("id"),
+        "content": msg.get("content"),
+    }
+    if RAW_MODE != "full":
+        # typed projection of the fields we query; everything else lives in raw_blob
+        row.update(_message_projection(msg))
+    return _with_raw(row, msg, "raw")
+
+
+def _upsert_rows(rows: List[dict], existing: set, counts: Dict[str, int], attempts: int):
+    """Upsert rows, retrying with backoff, then bisecting so one bad row only fails itself."""
+    for attempt in range(attempts):
+        try:
+            supabase.table("messages").upsert(rows, on_conflict="message_id").execute()
+            updated = sum(1 for r in rows if r.get("message_id") in existing)
+            counts["updated"] += updated
+            counts["inserted"] += len(rows) - updated
+            return
+        except Exception as e:
+            last_error = e
+            if attempt + 1 < attempts:
+                time.sleep(SYNC_UPSERT_BACKOFF * (2 ** attempt))
+    if len(rows) == 1:
+        logger.warning("failed upsert msg %s: %s", rows[0].get("message_id"), last_error)
+        counts["failed"] += 1
+        return
+    mid = len(rows) // 2
+    _upsert_rows(rows[:mid], existing, counts, 1)
+    _upsert_rows(rows[mid:], existing, counts, 1)
+
+
+def _insert_messages_rows(guild_id: str, all_messages: List[dict], chunk_size: int = SYNC_UPSERT_CHUNK,
+                          extra: Optional[Dict[str, dict]] = None) -> Dict[str, int]:
+    """Bulk-upsert Discord messages into ``messages`` keyed on message_id.
+
+    Re-syncing the same messages updates them instead of inserting duplicates
+    (needs a unique constraint on messages.message_id). ``extra`` maps a
+    message id to additional columns for its row. Returns counts of inserted,
+    updated and failed rows.
+    """
+    counts = {"inserted": 0, "updated": 0, "failed": 0}
+    if not supabase:
+        logger.warning("Supabase not configured - skipping insert")
+        counts["failed"] = len(all_messages)
+        return counts
 
-    if supabase and text:
+    # last copy of a message wins; postgres rejects the same key twice in one upsert
+    rows_by_id: Dict[str, dict] = {}
+    for msg in all_messages:
+        if isinstance(msg, dict) and msg.get("id"):
+            row = _message_row(guild_id, msg)
+            if extra and str(msg["id"]) in extra:
+                row.update(extra[str(msg["id"])])
+            rows_by_id[str(msg["id"])] = row
+    rows = list(rows_by_id.values())
+
+    for start in range(0, len(rows), max(1, chunk_size)):
+        chunk = rows[start:start + chunk_size]
         try:
-            supabase.table("audio_transcripts").insert({"transcript": text}).execute()
+            res = supabase.table("messages").select("message_id") \
+                .in_("message_id", [r["message_id"] for r in chunk]).execute()
+            existing = {r.get("message_id") for r in (res.data or [])}
         except Exception as e:
-            logger.warning("Failed to store transcript: %s", e)
+            logger.warning("Could not look up existing messages: %s", e)
+            existing = set()
+        _upsert_rows(chunk, existing, counts, max(1, SYNC_UPSERT_RETRIES))
+
+    logger.info("Upserted messages for %s: %s", guild_id, counts)
+    return counts
+
+
+# -----------------------------------------------------
+# INCREMENTAL SYNC (per-channel cursors)
+# -----------------------------------------------------
+SYNC_CURSOR_TABLE = "discord_sync_cursors"  # channel_id (unique), guild_id, last_message_id, updated_at
+
+
+def _load_sync_cursors(guild_id: str) -> Dict[str, str]:
+    """Return {channel_id: last stored message id} for the guild."""
+    if not supabase:
+        return {}
+    try:
+        rows = supabase.table(SYNC_CURSOR_TABLE).select("channel_id,last_message_id") \
+            .eq("guild_id", guild_id).execute().data or []
+    except Exception as e:
+        logger.warning("Could not load sync cursors for %s: %s", guild_id, e)
+        return {}
+    return {r["channel_id"]: r["last_message_id"] for r in rows if r.get("channel_id") and r.get("last_message_id")}
+
+
+def _save_sync_cursor(guild_id: str, channel_id: str, last_message_id: str) -> bool:
+    try:
+        supabase.table(SYNC_CURSOR_TABLE).upsert({
+            "channel_id": channel_id,
+            "guild_id": guild_id,
+            "last_message_id": last_message_id,
+            "updated_at": datetime.now(timezone.utc).isoformat(),
+        }, on_conflict="channel_id").execute()
+        return True
+    except Exception as e:
+        logger.warning("Could not save sync cursor for channel %s: %s", channel_id, e)
+        return False
+
+
+def _fetch_messages_page(channel_id: str, **params) -> Optional[List[dict]]:
+    """One GET /channels/{id}/messages page, or None if Discord returned an error."""
+    try:
+        msgs = discord.get(f"/channels/{channel_id}/messages", **params)
+    except Exception as e:
+        logger.warning("Invalid JSON for messages in channel %s: %s", channel_id, e)
+        return None
+
+    if isinstance(msgs, dict):
+        # could be error like Missing Access
+        logger.info("Discord returned error for channel %s: %s", channel_id, msgs)
+        return None
+
+    if not isinstance(msgs, list):
+        logger.info("Unexpected message format in channel %s: %s", channel_id, type(msgs))
+        return None
+
+    return [m for m in msgs if isinstance(m, dict) and m.get("id")]
+
+
+def _channel_pages(ch: dict, cursor: Optional[str], limit: int = 100):
+    """Yield the channel's pages after its cursor, oldest page first. Without a
+    cursor only the latest ``limit`` messages are taken (older history is the
+    backfill's job)."""
+    for _ in range(SYNC_MAX_PAGES):
+        if cursor:
+            msgs = _fetch_messages_page(ch["id"], after=cursor, limit=100)
+        else:
+            msgs = _fetch_messages_page(ch["id"], limit=limit)
+        if not msgs:
+            return
+        yield msgs
+        if not cursor or len(msgs) < 100:
+            return
+        cursor = max((m["id"] for m in msgs), key=int)
+
+
+# -----------------------------------------------------
+# SYNC PIPELINE (fetch -> normalize -> dedupe -> enrich -> store)
+# -----------------------------------------------------
+SYNC_FETCH_WORKERS = int(os.getenv("SYNC_FETCH_WORKERS", str(DISCORD_MAX_CONCURRENCY)))
+SYNC_ENRICH_WORKERS = int(os.getenv("SYNC_ENRICH_WORKERS", "2"))
+SYNC_STORE_WORKERS = int(os.getenv("SYNC_STORE_WORKERS", "2"))
+SYNC_QUEUE_PAGES = int(os.getenv("SYNC_QUEUE_PAGES", "8"))  # pages buffered between two stages
+SYNC_DEDUPE_WINDOW = int(os.getenv("SYNC_DEDUPE_WINDOW", "100000"))  # message ids remembered per run
+# analyze + embed new messages during sync (one analyze + one embed call per non-trivial
+# message). Off by default: it writes two columns the stock schema doesn't have, so run
+#   alter table messages add column label text, add column analysis jsonb;
+# before setting SYNC_ENRICH=1, or every upsert fails and the cursors never move.
+SYNC_ENRICH = os.getenv("SYNC_ENRICH", "0").lower() in ("1", "true", "yes")
+
+_PIPELINE_DONE = object()
+
+
+class StageCounters:
+    """Throughput counters for one pipeline stage, shared by every run."""
 
-    return {"text": text, "status": "stored in db"}
-# -----------------------------------------------------
-@app.post("/transcribe")
-async def transcribe_audio(file: UploadFile = File(...)):
-    audio_bytes = await file.read()
-    audio, sr = sf.read(io.BytesIO(audio_bytes))
-    if whisper_model is None:
-        return {"error": "Whisper model not available"}
-    result = whisper_model.transcribe(audio)
-    return {"text": result.get("text")}
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.items = 0  # channels for fetch, pages for the other stages
+        self.messages = 0
+        self.errors = 0
+        self.busy_seconds = 0.0
 
+    def record(self, messages: int, seconds: float, error: bool = False):
+        with self._lock:
+            self.items += 1
+            self.messages += messages
+            self.busy_seconds += seconds
+            self.errors += error
 
-@app.post("/transcribe_upload")
-async def transcribe_and_store(file: UploadFile = File(...)):
-    audio_bytes = await file.read()
-    audio, sr = sf.read(io.BytesIO(audio_bytes))
-    if whisper_model is None:
-        return {"error": "Whisper model not available"}
-    result = whisper_model.transcribe(audio)
-    text = result.get("text")
-    if supabase:
-        try:
-            supabase.table("audio_transcripts").insert({"transcript": text}).execute()
-        except Exception as e:
-            logger.warning("Failed to store transcript: %s", e)
-    return {"text": text, "status": "stored in db"}
+    def snapshot(self) -> dict:
+        with self._lock:
+            rate = self.messages / self.busy_seconds if self.busy_seconds else 0.0
+            return {"items": self.items, "messages": self.messages, "errors": self.errors,
+                    "busy_seconds": round(self.busy_seconds, 3), "messages_per_busy_second": round(rate, 1)}
 
-# -----------------------------------------------------
-# DISCORD OAUTH + BOT FLOW
-# -----------------------------------------------------
 
-# discord oauth url for user login
-DISCORD_OAUTH_URL = (
-    "https://discord.com/api/oauth2/authorize"
-    f"?client_id={DISCORD_CLIENT_ID}"
-    "&response_type=code"
-    "&scope=identify%20guilds"
-    f"&redirect_uri={DISCORD_REDIRECT_URI}"
-)
+PIPELINE_STAGES = ("fetch", "normalize", "dedupe", "enrich", "store")
+pipeline_counters = {name: StageCounters() for name in PIPELINE_STAGES}
 
-@app.get("/discord/login")
-def discord_login():
-    return RedirectResponse(DISCORD_OAUTH_URL)
 
+class _ChannelProgress:
+    """Moves a channel's cursor over the contiguous prefix of stored pages.
 
-@app.get("/oauth/discord/callback")
-def discord_callback(code: str):
-    # exchange code for user token
-    token_res = requests.post(
-        "https://discord.com/api/oauth2/token",
-        data={
-            "client_id": DISCORD_CLIENT_ID,
-            "client_secret": DISCORD_CLIENT_SECRET,
-            "grant_type": "authorization_code",
-            "code": code,
-            "redirect_uri": DISCORD_REDIRECT_URI,
-        },
-        headers={"Content-Type": "application/x-www-form-urlencoded"}
-    ).json()
+    Pages can finish out of order once stages run in parallel; the cursor
+    only passes a page when it and every page before it were stored, so a
+    failed page is fetched again on the next run.
+    """
 
-    access_token = token_res.get("access_token")
-    if not access_token:
-        logger.error("No access_token in token_res: %s", token_res)
-        return RedirectResponse("/discord/no_admin_guild")
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.next_seq = 0
+        self.stored: Dict[int, str] = {}  # seq -> newest id on the page
+        self.cursor: Optional[str] = None
 
-    # fetch user's guilds
-    guilds = requests.get(
-        "https://discord.com/api/v10/users/@me/guilds",
-        headers={"Authorization": f"Bearer {access_token}"}
-    ).json()
+    def page_stored(self, seq: int, newest: str) -> Optional[str]:
+        with self.lock:
+            self.stored[seq] = newest
+            advanced = None
+            while self.next_seq in self.stored:
+                advanced = self.stored.pop(self.next_seq)
+                self.next_seq += 1
+            if advanced is None:
+                return None
+            self.cursor = advanced
+            return advanced
 
-    # Option B: select guilds where user has ADMIN permission
-    admin_guilds = [g for g in (guilds or []) if (int(g.get("permissions", 0)) & 0x8) != 0]
-    if not admin_guilds:
-        return RedirectResponse("/discord/no_admin_guild")
 
-    selected = admin_guilds[0]
-    selected_guild_id = selected.get("id")
+class SyncPipeline:
+    """One guild sync as five stages joined by bounded queues.
 
-    # save user info + selected guild
-    if supabase:
-        try:
-            supabase.table("discord_users").insert({
-                "user_access_token": access_token,
-                "guilds": guilds,
-                "selected_guild": selected_guild_id
-            }).execute()
-        except Exception as e:
-            logger.warning("Failed to save discord_user: %s", e)
+    Work items are pages (dicts with channel, seq, messages). Each stage runs
+    its own worker threads; a full queue blocks the stage feeding it, so at
+    most a few pages per stage are in memory however large the guild is.
+    Workers pass the end-of-stream marker on once the whole stage is done.
+    """
 
-    # redirect to bot invite (preselect guild)
-    bot_auth_url = (
-        "https://discord.com/api/oauth2/authorize"
-        f"?client_id={DISCORD_CLIENT_ID}"
-        "&scope=bot%20applications.commands"
-        f"&guild_id={selected_guild_id}"
-        "&permissions=8"
-        f"&redirect_uri={DISCORD_REDIRECT_URI}"
-    )
-    return RedirectResponse(bot_auth_url)
+    def __init__(self, guild_id: str, cursors: Dict[str, str], limit: int = 100, enrich: bool = SYNC_ENRICH):
+        self.guild_id = guild_id
+        self.cursors = cursors
+        self.limit = limit
+        self.enrich_enabled = enrich
+        self.totals = {"fetched": 0, "inserted": 0, "updated": 0, "failed": 0, "duplicates": 0, "enriched": 0}
+        self._totals_lock = threading.Lock()
+        self._seen: "OrderedDict[str, Optional[str]]" = OrderedDict()  # id -> edited_timestamp
+        self._progress: Dict[str, _ChannelProgress] = {}
 
+    def _add(self, **counts):
+        with self._totals_lock:
+            for k, v in counts.items():
+                self.totals[k] += v
 
-@app.get("/discord/guild/{guild_id}/authorize_bot")
-def authorize_bot(guild_id: str):
-    bot_oauth = (
-        "https://discord.com/api/oauth2/authorize"
-        f"?client_id={DISCORD_CLIENT_ID}"
-        "&scope=bot%20applications.commands"
-        f"&guild_id={guild_id}"
-        "&permissions=8"
-        f"&redirect_uri={DISCORD_REDIRECT_URI}"
-    )
-    return RedirectResponse(bot_oauth)
+    # ---- stages: each takes one item and yields items for the next queue ----
+    def fetch(self, ch: dict):
+        self._progress[ch["id"]] = _ChannelProgress()
+        for seq, msgs in enumerate(_channel_pages(ch, self.cursors.get(ch["id"]), self.limit)):
+            self._add(fetched=len(msgs))
+            yield {"channel": ch, "seq": seq, "newest": max((m["id"] for m in msgs), key=int), "messages": msgs}
 
+    def normalize(self, page: dict):
+        ch = page["channel"]
+        for m in page["messages"]:
+            m["channel_id"] = ch.get("id")
+            m["channel_name"] = ch.get("name")
+        yield page
 
-@app.get("/discord/guild/{guild_id}/channels")
-def list_guild_channels(guild_id: str):
-    headers = {"Authorization": f"Bot {DISCORD_BOT_TOKEN}"}
-    res = requests.get(f"https://discord.com/api/v10/guilds/{guild_id}/channels", headers=headers)
-    try:
-        channels = res.json()
-    except Exception as e:
-        logger.warning("List channels json error: %s", e)
-        return {"error": str(e)}
-    return {"channels": channels}
+    def dedupe(self, page: dict):
+        # a message re-sent by an overlapping page (or an unchanged edit) is stored once per run
+        fresh = []
+        for m in page["messages"]:
+            key, edited = str(m["id"]), m.get("edited_timestamp")
+            if key in self._seen and self._seen[key] == edited:
+                continue
+            self._seen[key] = edited
+            self._seen.move_to_end(key)
+            fresh.append(m)
+        while len(self._seen) > SYNC_DEDUPE_WINDOW:
+            self._seen.popitem(last=False)
+        self._add(duplicates=len(page["messages"]) - len(fresh))
+        page["messages"] = fresh
+        yield page
 
+    def enrich(self, page: dict):
+        page["extra"] = {}
+        msgs = [m for m in page["messages"]
+                if not _is_trivial(m.get("content") or "", bool((m.get("author") or {}).get("bot")))]
+        if self.enrich_enabled and msgs:
+            # every analyze call is submitted before waiting so the batcher can pack them
+            futures = [cached_submit("analyze", analyze_batcher, m["content"]) for m in msgs]
+            for m, fut in zip(msgs, futures):
+                try:
+                    analysis = fut.result()
+                except Exception as e:
+                    logger.warning("Sync enrich failed for message %s: %s", m["id"], e)
+                    continue
+                label = analysis.get("label") if isinstance(analysis, dict) else None
+                page["extra"][str(m["id"])] = {"label": label, "analysis": analysis}
+            try:
+                vectors = _embed_texts([m["content"] for m in msgs])
+                get_vector_index(self.guild_id).add([str(m["id"]) for m in msgs], vectors)
+            except Exception as e:
+                logger.warning("Sync embedding failed for channel %s: %s", page["channel"].get("id"), e)
+            self._add(enriched=len(page["extra"]))
+        yield page
 
-@app.get("/discord/permissions/{guild_id}")
-def permissions_check(guild_id: str):
-    """Return a per-channel permission check for the bot."""
-    headers = {"Authorization": f"Bot {DISCORD_BOT_TOKEN}"}
-    channels = requests.get(f"https://discord.com/api/v10/guilds/{guild_id}/channels", headers=headers).json()
-    report = []
-    for ch in channels:
-        if not isinstance(ch, dict):
-            continue
-        ch_id = ch.get("id")
-        # fetch permission overwrite for the bot role via API is not possible easily; try fetching channel info
-        res = requests.get(f"https://discord.com/api/v10/channels/{ch_id}", headers=headers)
-        try:
-            ch_info = res.json()
-        except:
-            ch_info = {"error": "invalid json"}
-        report.append({"channel": ch.get("name"), "id": ch_id, "raw": ch_info})
-    return {"report": report}
+    def store(self, page: dict):
+        counts = _insert_messages_rows(self.guild_id, page["messages"], extra=page.get("extra")) \
+            if page["messages"] else {"inserted": 0, "updated": 0, "failed": 0}
+        self._add(**counts)
+        if counts["failed"]:
+            # the cursor stays before this page so the next run retries it
+            return ()
+        ch_id = page["channel"]["id"]
+        cursor = self._progress[ch_id].page_stored(page["seq"], page["newest"])
+        if cursor:
+            _save_sync_cursor(self.guild_id, ch_id, cursor)
+        return ()
 
+    # ---- plumbing ----
+    def _worker(self, name: str, fn, inq: "queue.Queue", outq: Optional["queue.Queue"], alive: List[int],
+                downstream_workers: int, lock: threading.Lock):
+        counters = pipeline_counters[name]
+        while True:
+            item = inq.get()
+            if item is _PIPELINE_DONE:
+                break
+            started = time.perf_counter()
+            blocked, produced, error = 0.0, 0, False
+            try:
+                for out in fn(item):
+                    produced += len(out["messages"])
+                    if outq is not None:
+                        # time spent waiting on a full downstream queue is not this stage's work
+                        wait_started = time.perf_counter()
+                        outq.put(out)
+                        blocked += time.perf_counter() - wait_started
+            except Exception as e:
+                logger.warning("Sync pipeline %s stage error: %s", name, e)
+                error = True
+            n = produced if name == "fetch" else len(item["messages"])
+            counters.record(n, time.perf_counter() - started - blocked, error)
+        with lock:
+            alive[0] -= 1
+            last = alive[0] == 0
+        if last and outq is not None:
+            for _ in range(downstream_workers):
+                outq.put(_PIPELINE_DONE)
 
-# -----------------------------------------------------
-# SYNC HELPERS (per-message insertion)
-# -----------------------------------------------------
+    def run(self, channels: List[dict]) -> Dict[str, int]:
+        stages = [
+            ("fetch", self.fetch, max(1, SYNC_FETCH_WORKERS)),
+            ("normalize", self.normalize, 1),
+            ("dedupe", self.dedupe, 1),  # single worker: owns the seen-ids window
+            ("enrich", self.enrich, max(1, SYNC_ENRICH_WORKERS)),
+            ("store", self.store, max(1, SYNC_STORE_WORKERS)),
+        ]
+        source: "queue.Queue" = queue.Queue()
+        for ch in channels:
+            source.put(ch)
+        for _ in range(stages[0][2]):
+            source.put(_PIPELINE_DONE)
+        queues = [source] + [queue.Queue(maxsize=max(1, SYNC_QUEUE_PAGES)) for _ in stages[1:]] + [None]
 
-def _insert_messages_rows(guild_id: str, all_messages: List[dict]):
-    if not supabase:
-        logger.warning("Supabase not configured - skipping insert")
-        return
+        threads = []
+        for i, (name, fn, workers) in enumerate(stages):
+            alive, lock = [workers], threading.Lock()
+            downstream = stages[i + 1][2] if i + 1 < len(stages) else 0
+            for w in range(workers):
+                t = threading.Thread(target=self._worker, name=f"sync-{name}-{w}", daemon=True,
+                                     args=(name, fn, queues[i], queues[i + 1], alive, downstream, lock))
+                t.start()
+                threads.append(t)
+        for t in threads:
+            t.join()
+        return dict(self.totals)
 
-    for msg in all_messages:
-        try:
-            author = msg.get("author", {}) or {}
-
-            supabase.table("messages").insert({
-                "source": "discord",
-                "guild_id": guild_id,
-                "channel_id": msg.get("channel_id"),
-                "channel_name": msg.get("channel_name"),
-                "author_id": author.get("id"),
-                "author_username": author.get("username"),
-                "message_id": msg.get("id"),
-                "content": msg.get("content"),
-                "raw": msg
-            }).execute()
-        except Exception as e:
-            logger.warning("failed insert msg %s: %s", msg.get("id"), e)("failed insert msg %s: %s", msg.get("id"), e)
+
+@app.get("/pipeline/stats")
+def pipeline_stats():
+    return {"enrich": SYNC_ENRICH, "stages": {name: c.snapshot() for name, c in pipeline_counters.items()}}
 
 
-def _sync_guild_messages(guild_id: str, limit: int = 100):
-    headers = {"Authorization": f"Bot {DISCORD_BOT_TOKEN}"}
-    res = requests.get(f"https://discord.com/api/v10/guilds/{guild_id}/channels", headers=headers)
+def _readable_text_channels(guild_id: str) -> Optional[Tuple[List[dict], int]]:
+    """The guild's text/thread/announcement channels the bot can read, and how many were skipped."""
     try:
-        channels = res.json()
+        channels = _guild_channels(guild_id)
     except Exception as e:
         logger.warning("Could not fetch channels for %s: %s", guild_id, e)
-        return
+        return None
+    if not isinstance(channels, list):
+        logger.warning("Could not fetch channels for %s: %s", guild_id, channels)
+        return None
 
     # show debug
     logger.info("SYNC DEBUG CHANNELS: %s", channels)
 
-    all_messages = []
-
-    for ch in channels:
-        if not isinstance(ch, dict):
-            continue
-        ctype = ch.get("type")
-        # fetch from text channels, threads and announcement channels
-        if ctype not in [0, 11, 12, 15, 5]:
-            continue
+    # fetch from text channels, threads and announcement channels
+    text_channels = [ch for ch in channels if isinstance(ch, dict) and ch.get("type") in [0, 11, 12, 15, 5]]
 
-        # GET messages - if channel is a thread or forum this returns posts/messages differently
-        msgs_res = requests.get(f"https://discord.com/api/v10/channels/{ch['id']}/messages?limit={limit}", headers=headers)
-        try:
-            msgs = msgs_res.json()
-        except Exception as e:
-            logger.warning("Invalid JSON for messages in channel %s: %s", ch.get("id"), e)
-            continue
+    # skip channels the bot can't read instead of collecting "Missing Access" errors
+    verdicts = _bot_channel_permissions(guild_id, channels)
+    skipped = 0
+    if verdicts is not None:
+        readable = [ch for ch in text_channels if verdicts.get(ch["id"], {}).get("read_history")]
+        skipped = len(text_channels) - len(readable)
+        text_channels = readable
+    return text_channels, skipped
 
-        if isinstance(msgs, dict):
-            # could be error like Missing Access
-            logger.info("Discord returned error for channel %s: %s", ch.get("id"), msgs)
-            continue
 
-        if not isinstance(msgs, list):
-            logger.info("Unexpected message format in channel %s: %s", ch.get("id"), type(msgs))
-            continue
+def _sync_guild_messages(guild_id: str, limit: int = 100) -> Optional[Dict[str, int]]:
+    found = _readable_text_channels(guild_id)
+    if found is None:
+        return None
+    text_channels, skipped = found
+    cursors = _load_sync_cursors(guild_id)
 
-        for m in msgs:
-            if not isinstance(m, dict):
-                continue
-            m["channel_id"] = ch.get("id")
-            m["channel_name"] = ch.get("name")
-            all_messages.append(m)
+    # channels are fetched concurrently; the client keeps each rate-limit bucket in check
+    totals = {"channels": len(text_channels), "skipped": skipped}
+    totals.update(SyncPipeline(guild_id, cursors, limit).run(text_channels))
 
-    # insert per-row
-    _insert_messages_rows(guild_id, all_messages)
+    logger.info("Synced guild %s: %s", guild_id, totals)
+    return totals
 
 
 @app.get("/discord/guild/{guild_id}/messages")
 def get_guild_messages(guild_id: str):
-    _sync_guild_messages(guild_id)
-    return {"saved": True}
+    result = _sync_guild_messages(guild_id)
+    return {"saved": True, "result": result}
 
 
 @app.get("/discord/dm_messages")
 def get_dm_messages():
-    headers = {"Authorization": f"Bot {DISCORD_BOT_TOKEN}"}
-    dm_channels = requests.get("https://discord.com/api/v10/users/@me/channels", headers=headers).json()
-    all_dms = []
-    for dm in dm_channels:
-        msgs = requests.get(f"https://discord.com/api/v10/channels/{dm['id']}/messages?limit=50", headers=headers).json()
+    dm_channels = discord.get("/users/@me/channels")
+
+    def _fetch_dm(dm: dict) -> List[dict]:
+        msgs = _fetch_messages_page(dm["id"], limit=50) or []
         for m in msgs:
             m["dm_channel_id"] = dm.get("id")
-            all_dms.append(m)
-    _insert_messages_rows("dm", all_dms)
-    return {"saved": True, "count": len(all_dms)}
+        return msgs
+
+    all_dms = []
+    for msgs in discord.map(_fetch_dm, [dm for dm in dm_channels if isinstance(dm, dict)]):
+        all_dms.extend(msgs)
+    result = _insert_messages_rows("dm", all_dms)
+    return {"saved": True, "count": len(all_dms), "result": result}
 
 
 @app.post("/discord/events")
 def discord_events(payload: dict):
+    _invalidate_for_event(payload)
     if not supabase:
         return {"ok": False, "error": "supabase not configured"}
-    supabase.table("discord_events").insert({"event": payload}).execute()
+    write_behind["discord_events"].put(_event_row(payload))
     return {"ok": True}
 
 
 # -------------------------------------------------------------
-# PERIODIC SYNC (every 5 minutes) - only sync guilds where user has ADMIN and bot is present
+# HISTORY BACKFILL (resumable, to local Parquet, bulk-loaded later)
 # -------------------------------------------------------------
-_scheduler_started = False
+# <BACKFILL_DIR>/<guild>/<channel>/<YYYY-MM-DD>/part-<oldest id>-<newest id>.parquet plus
+# <BACKFILL_DIR>/<guild>/_checkpoint.json. Ids stay columns in the files (not hive keys)
+# so any Parquet reader gets them with their string type. Use guild "dm" for the bot's DMs.
+BACKFILL_DIR = os.getenv("BACKFILL_DIR", "backfill")
+BACKFILL_FLUSH_ROWS = int(os.getenv("BACKFILL_FLUSH_ROWS", "5000"))  # per channel buffer before writing parts
+BACKFILL_CONCURRENCY = int(os.getenv("BACKFILL_CONCURRENCY", "4"))  # channels paged at once
 
+_backfill_lock = threading.Lock()
+backfill_jobs: Dict[str, dict] = {}
 
-def _periodic_sync_loop(interval_seconds: int = 300):
-    while True:
+
+def _backfill_root(guild_id: str) -> str:
+    # the guild id comes from the URL; keep it to one safe path component
+    return os.path.join(BACKFILL_DIR, re.sub(r"[^A-Za-z0-9_-]", "_", guild_id or "default"))
+
+
+def _job_add(job: dict, field: str, n: int):
+    # channels of one job run on several threads
+    with _backfill_lock:
+        job[field] += n
+
+
+def _backfill_schema():
+    import pyarrow as pa
+
+    ts = pa.timestamp("us", tz="UTC")
+    return pa.schema([
+        ("message_id", pa.string()), ("guild_id", pa.string()), ("channel_id", pa.string()),
+        ("channel_name", pa.string()), ("author_id", pa.string()), ("author_username", pa.string()),
+        ("author_bot", pa.bool_()), ("content", pa.string()), ("created_at", ts), ("edited_at", ts),
+        ("message_type", pa.int32()), ("reply_to", pa.string()), ("mention_count", pa.int32()),
+        ("attachment_count", pa.int32()), ("embed_count", pa.int32()), ("reaction_count", pa.int32()),
+        ("pinned", pa.bool_()), ("raw", pa.string()),  # full Discord object as JSON, for the bulk load
+    ])
+
+
+def _parse_ts(value: Optional[str]) -> Optional[datetime]:
+    return datetime.fromisoformat(value) if value else None
+
+
+def _backfill_record(guild_id: str, msg: dict) -> dict:
+    author = msg.get("author", {}) or {}
+    record = {
+        "message_id": str(msg["id"]),
+        "guild_id": guild_id,
+        "channel_id": msg.get("channel_id"),
+        "channel_name": msg.get("channel_name"),
+        "author_id": author.get("id"),
+        "author_username": author.get("username"),
+        "content": msg.get("content"),
+        "raw": json.dumps(msg, ensure_ascii=False, separators=(",", ":")),
+    }
+    record.update(_message_projection(msg))
+    record["created_at"] = _parse_ts(record["created_at"])
+    record["edited_at"] = _parse_ts(record["edited_at"])
+    return record
+
+
+class BackfillCheckpoint:
+    """Per-guild progress file: for each channel the oldest id already written
+    (the next ``before=``), whether it reached the start of history, and which
+    part files were bulk-loaded. Rewritten atomically after every flush."""
+
+    def __init__(self, guild_id: str):
+        self.root = _backfill_root(guild_id)
+        self.path = os.path.join(self.root, "_checkpoint.json")
+        self._lock = threading.Lock()
         try:
-            if not DISCORD_BOT_TOKEN:
-                logger.warning("No DISCORD_BOT_TOKEN set, skipping periodic sync")
-                time.sleep(interval_seconds)
-                continue
+            with open(self.path, encoding="utf-8") as f:
+                self.state = json.load(f)
+        except FileNotFoundError:
+            self.state = {"channels": {}, "loaded": []}
+
+    def channel(self, channel_id: str) -> dict:
+        with self._lock:
+            return dict(self.state["channels"].get(channel_id, {"before": None, "done": False, "messages": 0}))
+
+    def update(self, channel_id: str, **fields):
+        with self._lock:
+            self.state["channels"].setdefault(channel_id, {"before": None, "done": False, "messages": 0}).update(fields)
+            self._save()
+
+    def mark_loaded(self, part: str):
+        with self._lock:
+            self.state["loaded"].append(part)
+            self._save()
+
+    def _save(self):
+        os.makedirs(self.root, exist_ok=True)
+        self.state["updated_at"] = datetime.now(timezone.utc).isoformat()
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.state, f)
+        os.replace(tmp, self.path)
+
+
+def _write_backfill_parts(guild_id: str, channel_id: str, records: List[dict]) -> int:
+    """Write buffered records as one part file per day. Part names come from the
+    message ids they hold, so re-running a page after a crash overwrites the
+    same file instead of duplicating it."""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = _backfill_schema()
+    by_day: Dict[str, List[dict]] = {}
+    for r in records:
+        day = r["created_at"].date().isoformat() if r["created_at"] else "unknown"
+        by_day.setdefault(day, []).append(r)
+    for day, rows in by_day.items():
+        ids = sorted((r["message_id"] for r in rows), key=int)
+        folder = os.path.join(_backfill_root(guild_id), channel_id, day)
+        os.makedirs(folder, exist_ok=True)
+        path = os.path.join(folder, f"part-{ids[0]}-{ids[-1]}.parquet")
+        tmp = f"{path}.{os.getpid()}.tmp"
+        pq.write_table(pa.Table.from_pylist(rows, schema=schema), tmp, compression="zstd")
+        os.replace(tmp, path)
+    return len(by_day)
 
-            headers = {"Authorization": f"Bot {DISCORD_BOT_TOKEN}"}
-            guilds_resp = requests.get("https://discord.com/api/v10/users/@me/guilds", headers=headers).json()
 
-            if isinstance(guilds_resp, dict):
-                logger.warning("Error fetching bot guilds: %s", guilds_resp)
-                time.sleep(interval_seconds)
+def _backfill_channel(guild_id: str, ch: dict, checkpoint: BackfillCheckpoint, job: dict):
+    """Page backwards from the checkpoint until the channel's first message."""
+    state = checkpoint.channel(ch["id"])
+    if state["done"]:
+        return
+    before, total = state["before"], state["messages"]
+    buffer: List[dict] = []
+    while True:
+        params = {"limit": 100}
+        if before:
+            params["before"] = before
+        msgs = _fetch_messages_page(ch["id"], **params)
+        if msgs is None:
+            # Discord error: keep the checkpoint where it is so the next run resumes here
+            if buffer:
+                _job_add(job, "parts", _write_backfill_parts(guild_id, ch["id"], buffer))
+                checkpoint.update(ch["id"], before=before, messages=total)
+            _job_add(job, "errors", 1)
+            return
+        for m in msgs:
+            m["channel_id"] = ch.get("id")
+            m["channel_name"] = ch.get("name")
+            buffer.append(_backfill_record(guild_id, m))
+        if msgs:
+            before = min((m["id"] for m in msgs), key=int)
+            total += len(msgs)
+            _job_add(job, "messages", len(msgs))
+        finished = len(msgs) < 100
+        if buffer and (finished or len(buffer) >= BACKFILL_FLUSH_ROWS):
+            _job_add(job, "parts", _write_backfill_parts(guild_id, ch["id"], buffer))
+            buffer = []
+        if finished or not buffer:
+            # the checkpoint only moves past what is on disk
+            checkpoint.update(ch["id"], before=before, messages=total, done=finished)
+        if finished:
+            return
+
+
+def _backfill_channels(guild_id: str) -> Optional[List[dict]]:
+    if guild_id == "dm":
+        dms = discord.get("/users/@me/channels")
+        return [dm for dm in dms if isinstance(dm, dict)] if isinstance(dms, list) else None
+    found = _readable_text_channels(guild_id)
+    return found[0] if found else None
+
+
+def run_backfill(guild_id: str) -> dict:
+    """Backfill every readable channel of the guild; safe to re-run after a crash."""
+    with _backfill_lock:
+        job = backfill_jobs.get(guild_id)
+        if job and job["state"] == "running":
+            return job
+        job = backfill_jobs[guild_id] = {"state": "running", "messages": 0, "parts": 0, "errors": 0,
+                                         "started_at": datetime.now(timezone.utc).isoformat()}
+    try:
+        channels = _backfill_channels(guild_id)
+        if channels is None:
+            raise RuntimeError(f"could not list channels for {guild_id}")
+        checkpoint = BackfillCheckpoint(guild_id)
+        job["channels"] = len(channels)
+        # own pool: these tasks run for a channel's whole history and would starve
+        # every other discord.map caller on the client's shared executor
+        with ThreadPoolExecutor(max_workers=max(1, BACKFILL_CONCURRENCY),
+                                thread_name_prefix=f"backfill-{guild_id}") as pool:
+            list(pool.map(lambda ch: _backfill_channel(guild_id, ch, checkpoint, job), channels))
+        job["state"] = "done"
+    except Exception as e:
+        logger.exception("Backfill of %s failed", guild_id)
+        job.update(state="failed", error=str(e))
+    job["finished_at"] = datetime.now(timezone.utc).isoformat()
+    return job
+
+
+def load_backfill(guild_id: str) -> Dict[str, int]:
+    """Bulk-upsert the guild's part files into ``messages``, skipping parts already loaded."""
+    import pyarrow.parquet as pq
+
+    checkpoint = BackfillCheckpoint(guild_id)
+    loaded = set(checkpoint.state["loaded"])
+    totals = {"parts": 0, "inserted": 0, "updated": 0, "failed": 0}
+    for folder, _, files in sorted(os.walk(checkpoint.root)):
+        for name in sorted(f for f in files if f.endswith(".parquet")):
+            part = os.path.relpath(os.path.join(folder, name), checkpoint.root)
+            if part in loaded:
                 continue
+            failed = 0
+            for batch in pq.ParquetFile(os.path.join(folder, name)).iter_batches(
+                    batch_size=SYNC_UPSERT_CHUNK, columns=["raw"]):
+                msgs = [json.loads(raw) for raw in batch.column("raw").to_pylist()]
+                counts = _insert_messages_rows(guild_id, msgs)
+                failed += counts["failed"]
+                for k in ("inserted", "updated", "failed"):
+                    totals[k] += counts[k]
+            if not failed:
+                checkpoint.mark_loaded(part)
+            totals["parts"] += 1
+    return totals
 
-            # keep only guilds where the bot is present and where the selected user is admin (we use stored selected_guilds)
-            if supabase:
-                try:
-                    rows = supabase.table("discord_users").select("selected_guild").execute()
-                    selected_ids = [r.get("selected_guild") for r in (rows.data or []) if r.get("selected_guild")]
-                except Exception as e:
-                    logger.warning("Could not read discord_users: %s", e)
-                    selected_ids = []
+
+@app.post("/discord/backfill/{guild_id}")
+def discord_backfill(guild_id: str, background_tasks: BackgroundTasks):
+    background_tasks.add_task(run_backfill, guild_id)
+    return {"backfill_started": True}
+
+
+@app.get("/discord/backfill/{guild_id}")
+def discord_backfill_status(guild_id: str):
+    checkpoint = BackfillCheckpoint(guild_id)
+    channels = checkpoint.state["channels"]
+    return {
+        "job": backfill_jobs.get(guild_id),
+        "channels_done": sum(1 for c in channels.values() if c.get("done")),
+        "channels_started": len(channels),
+        "messages": sum(c.get("messages", 0) for c in channels.values()),
+        "parts_loaded": len(checkpoint.state["loaded"]),
+    }
+
+
+@app.post("/discord/backfill/{guild_id}/load")
+def discord_backfill_load(guild_id: str):
+    if not supabase:
+        return {"error": "supabase not configured"}
+    return load_backfill(guild_id)
+
+
+# -------------------------------------------------------------
+# PERIODIC SYNC - one leader per host, per-guild adaptive schedule
+# only syncs guilds a user selected and the bot is present in
+# -------------------------------------------------------------
+SYNC_INTERVAL = float(os.getenv("SYNC_INTERVAL", "300"))
+SYNC_MIN_INTERVAL = float(os.getenv("SYNC_MIN_INTERVAL", "60"))
+SYNC_MAX_INTERVAL = float(os.getenv("SYNC_MAX_INTERVAL", "1800"))
+SYNC_JITTER = float(os.getenv("SYNC_JITTER", "0.1"))  # +/- fraction of the interval
+SYNC_WORKERS = int(os.getenv("SYNC_WORKERS", "4"))
+SYNC_REFRESH_SECONDS = float(os.getenv("SYNC_REFRESH_SECONDS", "300"))  # re-read the guild list
+SYNC_LEADER_RETRY = float(os.getenv("SYNC_LEADER_RETRY", "30"))  # followers re-try the lock
+SYNC_LOCK_PATH = os.getenv("SYNC_LOCK_PATH", os.path.join(tempfile.gettempdir(), "contextqi-sync.lock"))
+
+
+def _selected_guild_ids() -> List[str]:
+    """Deduplicated selected guilds, narrowed to the ones the bot is actually in."""
+    if not supabase:
+        return []
+    try:
+        rows = supabase.table("discord_users").select("selected_guild").execute()
+    except Exception as e:
+        logger.warning("Could not read discord_users: %s", e)
+        return []
+    selected = {r.get("selected_guild") for r in (rows.data or []) if r.get("selected_guild")}
+    bot_guilds = _bot_guilds()
+    if isinstance(bot_guilds, list):
+        selected &= {g.get("id") for g in bot_guilds if isinstance(g, dict)}
+    else:
+        logger.warning("Error fetching bot guilds: %s", bot_guilds)
+    return sorted(selected)
+
+
+class SyncScheduler:
+    """Runs periodic guild syncs in exactly one worker process.
+
+    Leadership is an exclusive flock on SYNC_LOCK_PATH; the other uvicorn
+    workers keep retrying it, so one of them takes over if the leader dies
+    (the kernel drops the lock with the process). The leader keeps a heap of
+    (due, guild_id): each guild runs on its own interval, halved when a sync
+    inserts new messages and stretched by half when it finds nothing, within
+    [SYNC_MIN_INTERVAL, SYNC_MAX_INTERVAL], and jittered so guilds don't align.
+    """
+
+    def __init__(self, lock_path: str = SYNC_LOCK_PATH, workers: int = SYNC_WORKERS):
+        self.lock_path = lock_path
+        self._lock_file = None
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="guild-sync")
+        self._cond = threading.Condition()
+        self._heap: List[Tuple[float, str]] = []
+        self._intervals: Dict[str, float] = {}
+        self._running: set = set()
+        self._last: Dict[str, dict] = {}
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    # ---- leadership ----
+    def _try_lead(self) -> bool:
+        f = open(self.lock_path, "a+")
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            f.close()
+            return False
+        f.seek(0)
+        f.truncate()
+        f.write(str(os.getpid()))
+        f.flush()
+        self._lock_file = f
+        return True
+
+    @property
+    def is_leader(self) -> bool:
+        return self._lock_file is not None
+
+    # ---- scheduling ----
+    def _jittered(self, interval: float) -> float:
+        return interval * (1 + SYNC_JITTER * (2 * np.random.random() - 1))
+
+    def _refresh(self, guild_ids: List[str]):
+        wanted = set(guild_ids)
+        now = time.monotonic()
+        with self._cond:
+            for gid in wanted - set(self._intervals):
+                self._intervals[gid] = SYNC_INTERVAL
+                # spread the first round over one interval instead of a thundering start
+                heapq.heappush(self._heap, (now + np.random.random() * SYNC_INTERVAL, gid))
+            for gid in set(self._intervals) - wanted:
+                self._intervals.pop(gid, None)
+                self._last.pop(gid, None)
+            # stale heap entries for dropped guilds are skipped when popped
+            self._cond.notify()
+
+    def _run_guild(self, gid: str):
+        started = time.monotonic()
+        try:
+            totals = _sync_guild_messages(gid)
+        except Exception as exc:
+            logger.warning("Error syncing guild %s: %s", gid, exc)
+            totals = None
+        with self._cond:
+            self._running.discard(gid)
+            interval = self._intervals.get(gid)
+            if interval is None:
+                return
+            if totals is None:
+                interval = SYNC_INTERVAL
+            elif totals.get("inserted"):
+                interval = max(SYNC_MIN_INTERVAL, interval / 2)
             else:
-                selected_ids = []
+                interval = min(SYNC_MAX_INTERVAL, interval * 1.5)
+            self._intervals[gid] = interval
+            self._last[gid] = {"totals": totals, "seconds": round(time.monotonic() - started, 3)}
+            heapq.heappush(self._heap, (time.monotonic() + self._jittered(interval), gid))
+            self._cond.notify()
 
-            # sync only selected ids to avoid Missing Access
-            for gid in selected_ids:
+    def _loop(self):
+        while not self._stop.is_set() and not self._try_lead():
+            self._stop.wait(SYNC_LEADER_RETRY)
+        if self._stop.is_set():
+            return
+        logger.info("Periodic sync leader: pid %s", os.getpid())
+        next_refresh = 0.0
+        while not self._stop.is_set():
+            now = time.monotonic()
+            if now >= next_refresh:
                 try:
-                    _sync_guild_messages(gid)
-                except Exception as exc:
-                    logger.warning("Error syncing guild %s: %s", gid, exc)
-        except Exception as e:
-            logger.exception("Periodic sync top-level error")
-        time.sleep(interval_seconds)
+                    self._refresh(_selected_guild_ids() if DISCORD_BOT_TOKEN else [])
+                except Exception:
+                    logger.exception("Periodic sync refresh error")
+                next_refresh = now + SYNC_REFRESH_SECONDS
+            with self._cond:
+                due = []
+                while self._heap and self._heap[0][0] <= now:
+                    _, gid = heapq.heappop(self._heap)
+                    if gid in self._intervals and gid not in self._running:
+                        self._running.add(gid)
+                        due.append(gid)
+                wake = min(self._heap[0][0] if self._heap else next_refresh, next_refresh)
+            for gid in due:
+                self._pool.submit(self._run_guild, gid)
+            with self._cond:
+                self._cond.wait(max(0.0, wake - time.monotonic()))
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._loop, name="sync-scheduler", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        with self._cond:
+            self._cond.notify()
+        self._pool.shutdown(wait=False, cancel_futures=True)
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+
+    def status(self) -> dict:
+        now = time.monotonic()
+        with self._cond:
+            due = {gid: round(t - now, 1) for t, gid in self._heap if gid in self._intervals}
+            return {
+                "leader": self.is_leader,
+                "pid": os.getpid(),
+                "running": sorted(self._running),
+                "guilds": {
+                    gid: {"interval": round(iv, 1), "next_in": due.get(gid), **self._last.get(gid, {})}
+                    for gid, iv in self._intervals.items()
+                },
+            }
+
+
+sync_scheduler = SyncScheduler()
 
 
 @app.on_event("startup")
 def _start_periodic_sync():
-    global _scheduler_started
-    if not _scheduler_started:
-        t = threading.Thread(target=_periodic_sync_loop, args=(300,), daemon=True)
-        t.start()
-        _scheduler_started = True
+    if not DISCORD_BOT_TOKEN:
+        logger.warning("No DISCORD_BOT_TOKEN set, skipping periodic sync")
+        return
+    sync_scheduler.start()
+
+
+@app.on_event("shutdown")
+def _stop_periodic_sync():
+    sync_scheduler.stop()
+
+
+@app.get("/discord/sync/schedule")
+def discord_sync_schedule():
+    return sync_scheduler.status()
 
 
 @app.post("/discord/sync/{guild_id}")
@@ -591,12 +4314,190 @@ def connected_guilds():
     return {"connected": res.data}
 
 
+# -----------------------------------------------------
+# ASYNC I/O ROUTES (ASYNC_IO=1)
+# -----------------------------------------------------
+# Same paths and payloads as the sync handlers above, but nothing here holds a
+# threadpool slot while waiting on Gemini or Discord (DB writes go write-behind).
+# Flip ASYNC_IO to benchmark one mode against the other.
+async_router = APIRouter()
+
+
+async def _aget(name: str):
+    """Registry lookup that loads off the event loop the first time."""
+    value = registry._values.get(name, _NOT_LOADED)
+    if value is _NOT_LOADED:
+        value = await asyncio.to_thread(registry.get, name)
+    return value
+
+
+async def _agenerate(prompt: str) -> str:
+    model = await _aget("gemini_model")
+    async with admission[GEMINI_MODEL].aslot():
+        response = await model.generate_content_async(prompt)
+    return response.text
+
+
+async def _aembed(text: str) -> List[float]:
+    key = ResponseCache.make_key("embed", GEMINI_EMBED_MODEL, text)
+    hit = await response_cache.aget("embed", key)
+    if hit is not None:
+        return hit
+    # coalesce on the same Future the sync path uses; it is shared across threads
+    return await asyncio.wrap_future(inflight.future(key, lambda: asyncio.run_coroutine_threadsafe(
+        _aembed_fetch(key, text), asyncio.get_running_loop())))
+
+
+async def _aembed_fetch(key: str, text: str) -> List[float]:
+    genai_sdk = await _aget("genai")
+    async with admission[GEMINI_EMBED_MODEL].aslot():
+        result = await genai_sdk.embed_content_async(model=GEMINI_EMBED_MODEL, content=text)
+    response_cache.set(key, result["embedding"])
+    return result["embedding"]
+
+
+async def _asubmit(route: str, batcher: GeminiBatcher, text: str,
+                   on_fresh: Optional[Callable[[object], None]] = None):
+    key = ResponseCache.make_key(route, GEMINI_MODEL, text)
+    hit = await response_cache.aget(route, key)
+    if hit is not None:
+        return hit
+    # the batcher's threads make the upstream call; this handler just awaits the future
+    return await asyncio.wrap_future(_submit_uncached(key, batcher, text, on_fresh))
+
+
+def _batched_route(route: str, batcher: GeminiBatcher, label: str,
+                   local: Optional[Callable[[str], Optional[dict]]] = None):
+    async def handler(payload: TextIn):
+        if local is not None:
+            answer = local(payload.text)
+            if answer is not None:
+                return answer
+        started = time.perf_counter()
+        try:
+            on_fresh = (lambda r: preclassifier.observe(payload.text, r)) if route == "classify" else None
+            result = await _asubmit(route, batcher, payload.text, on_fresh)
+            if local is not None:
+                preclassifier.escalated(route, started)
+            return result
+        except HTTPException:
+            raise
+        except Exception as e:
+            logger.exception("%s error", label)
+            return {"error": str(e)}
+    handler.__name__ = f"{route}_async"
+    return handler
+
+
+async_router.add_api_route("/ner", _batched_route("ner", ner_batcher, "NER", preclassifier.ner), methods=["POST"])
+async_router.add_api_route("/classify", _batched_route("classify", classify_batcher, "Classify", preclassifier.classify),
+                           methods=["POST"])
+async_router.add_api_route("/extract", _batched_route("extract", extract_batcher, "Extract"), methods=["POST"])
+async_router.add_api_route("/analyze", _batched_route("analyze", analyze_batcher, "Analyze"), methods=["POST"])
+
+
+@async_router.post("/analyze/batch")
+async def analyze_batch_async(payload: TextsIn):
+    results = await asyncio.gather(
+        *[_asubmit("analyze", analyze_batcher, t) for t in payload.texts], return_exceptions=True
+    )
+    return {"results": [{"error": str(r)} if isinstance(r, Exception) else r for r in results]}
+
+
+@async_router.post("/embed")
+async def embed_async(payload: TextIn):
+    try:
+        return {"embedding": await _aembed(payload.text)}
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.exception("Embedding error")
+        return {"error": str(e)}
+
+
+@async_router.post("/generate")
+async def generate_async(payload: TextIn):
+    key = ResponseCache.make_key("generate", GEMINI_MODEL, payload.text)
+    try:
+        reply = await response_cache.aget("generate", key)
+        if reply is None:
+            reply = await _agenerate(_generate_prompt(payload.text))
+            response_cache.set(key, reply)
+        return {"response": reply}
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.exception("Generate error")
+        return {"error": str(e)}
+
+
+@async_router.post("/chat")
+async def chat_async(payload: ChatIn):
+    session_id = _chat_session_id(payload)
+    prompt = chat_memory.build_prompt(session_id, payload.text)
+    try:
+        reply = await _agenerate(prompt)
+    except Exception as e:
+        logger.exception("Chat error")
+        reply = "Sorry, I couldn't generate a response right now."
+    else:
+        chat_memory.record(session_id, payload.text, reply)
+    _save_chat(payload.text, reply)  # write-behind: never waits on the database
+    return {"response": reply, "session_id": session_id}
+
+
+@async_router.post("/chat_db")
+async def chat_db_async(payload: ChatIn):
+    return await chat_async(payload)
+
+
+@async_router.get("/discord/guild/{guild_id}/channels")
+async def list_guild_channels_async(guild_id: str):
+    try:
+        channels = meta_cache.peek("guild_channels", guild_id)
+        if channels is None:
+            channels = await discord.aget(f"/guilds/{guild_id}/channels")
+            if isinstance(channels, list):
+                meta_cache.put("guild_channels", guild_id, channels)
+    except Exception as e:
+        logger.warning("List channels json error: %s", e)
+        return {"error": str(e)}
+    return {"channels": channels}
+
+
+def _install_async_routes():
+    """Replace the sync handlers that async_router re-implements."""
+    overridden = {(route.path, method) for route in async_router.routes for method in route.methods}
+    app.router.routes = [
+        route for route in app.router.routes
+        if not (isinstance(route, APIRoute) and any((route.path, m) in overridden for m in route.methods))
+    ]
+    app.include_router(async_router)
+
+
+if ASYNC_IO:
+    _install_async_routes()
+
+
 # -----------------------------------------------------
 # SMALL UTIL: health
 # -----------------------------------------------------
 @app.get("/health")
 def health():
-    return {"ok": True}
+    return {"ok": True, "async_io": ASYNC_IO}
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Discord history backfill")
+    parser.add_argument("command", choices=["backfill", "load"])
+    parser.add_argument("guild_id", help='guild id, or "dm" for the bot\'s DM channels')
+    args = parser.parse_args()
+    if args.command == "backfill":
+        print(json.dumps(run_backfill(args.guild_id), indent=2))
+    else:
+        print(json.dumps(load_backfill(args.guild_id), indent=2))
 
 
 # End of file
@@ -0,0 +1,169 @@
+"""Whisper helpers that run inside the transcription pool processes.
+
+Kept apart from new_backend so spawned workers import only numpy, scipy,
+soundfile and whisper instead of the whole web app, and so the web app
+itself never imports whisper or scipy.
+"""
+import math
+import logging
+from typing import List, Optional, Tuple
+
+import numpy as np
+import soundfile as sf
+
+logger = logging.getLogger("transcribe_worker")
+
+SAMPLE_RATE = 16000  # what Whisper expects
+DECODE_BLOCK_SECONDS = 10
+RESAMPLE_CONTEXT = 256  # input samples of context around each resampled block
+
+_model = None
+
+
+def init_worker(model_name: str):
+    """Pool initializer: load this process's own Whisper model."""
+    global _model
+    try:
+        import whisper
+        _model = whisper.load_model(model_name)
+    except Exception as e:
+        logger.warning("Whisper model load failed: %s", e)
+        _model = None
+
+
+def is_ready() -> bool:
+    return _model is not None
+
+
+def decode_to_pcm(src_path: str, pcm_path: str, max_seconds: Optional[float] = None) -> int:
+    """Stream-decode an audio file into a 16 kHz mono float32 file; return its sample count.
+
+    The file is read in blocks of DECODE_BLOCK_SECONDS, downmixed, resampled
+    and written straight into a memory-mapped output, so peak memory is one
+    block no matter how long the recording is. Each block is resampled with a
+    little real context on both sides and only its own span is kept, which
+    avoids filter edge clicks at block boundaries.
+    """
+    from scipy.signal import resample_poly  # only pool workers pay for scipy
+
+    with sf.SoundFile(src_path) as f:
+        sr, frames = f.samplerate, f.frames
+        if max_seconds and frames > max_seconds * sr:
+            raise ValueError(f"audio is longer than {max_seconds:.0f}s")
+        g = math.gcd(sr, SAMPLE_RATE)
+        up, down = SAMPLE_RATE // g, sr // g
+        total = -(-frames * up // down)
+        out = np.memmap(pcm_path, dtype=np.float32, mode="w+", shape=(max(total, 1),))
+        # block starts stay multiples of ``down`` so output offsets are exact
+        block = down * max(1, (sr * DECODE_BLOCK_SECONDS) // down)
+        ctx = 0 if up == down else down * -(-RESAMPLE_CONTEXT // down)
+        for start in range(0, frames, block):
+            stop = min(start + block, frames)
+            lead = min(ctx, start)
+            f.seek(start - lead)
+            data = f.read(lead + (stop - start) + ctx, dtype="float32", always_2d=True).mean(axis=1)
+            if up != down:
+                data = resample_poly(data, up, down)
+                skip = lead * up // down
+                data = data[skip:skip + -(-(stop - start) * up // down)]
+            o = start * up // down
+            data = data[:total - o]
+            out[o:o + len(data)] = data
+        out.flush()
+        del out
+    return total
+
+
+def _frame_energy(audio: np.ndarray, frame: int, chunk_frames: int = 8192) -> np.ndarray:
+    """RMS per frame, computed chunk by chunk so a memmap is never copied whole."""
+    nframes = len(audio) // frame
+    energy = np.empty(nframes, dtype=np.float32)
+    for i in range(0, nframes, chunk_frames):
+        j = min(i + chunk_frames, nframes)
+        block = np.asarray(audio[i * frame:j * frame], dtype=np.float32).reshape(j - i, frame)
+        energy[i:j] = np.sqrt(np.mean(np.square(block), axis=1))
+    return energy
+
+
+def split_on_silence(audio: np.ndarray, segment_seconds: float = 28.0, search_seconds: float = 6.0,
+                     overlap_seconds: float = 1.0, frame_ms: int = 30) -> List[Tuple[int, int, int, int]]:
+    """Plan segments of at most ``segment_seconds`` cut at the quietest frame.
+
+    Frame RMS energy is computed once with NumPy; each cut is placed at the
+    lowest-energy frame in the last ``search_seconds`` before the length limit,
+    so words are rarely split. Returns (start, stop, core_start, core_stop)
+    sample offsets: start/stop include ``overlap_seconds`` of context on both
+    sides, core is the part this segment is responsible for when stitching.
+    """
+    n = len(audio)
+    target = int(segment_seconds * SAMPLE_RATE)
+    if n <= target:
+        return [(0, n, 0, n)]
+
+    frame = max(1, int(SAMPLE_RATE * frame_ms / 1000))
+    energy = _frame_energy(audio, frame)
+    nframes = len(energy)
+
+    # never search further back than half a segment, so short segments still move forward
+    search = int(min(search_seconds, segment_seconds / 2) * SAMPLE_RATE)
+    cuts = [0]
+    pos = 0
+    while n - pos > target:
+        lo = max(pos // frame + 1, (pos + target - search) // frame)
+        hi = min((pos + target) // frame, nframes)
+        if hi > lo:
+            cut = (lo + int(np.argmin(energy[lo:hi]))) * frame + frame // 2
+        else:
+            cut = pos + target
+        if cut <= pos:
+            cut = pos + target
+        cuts.append(cut)
+        pos = cut
+    cuts.append(n)
+
+    overlap = int(overlap_seconds * SAMPLE_RATE)
+    return [(max(0, a - overlap), min(n, b + overlap), a, b) for a, b in zip(cuts[:-1], cuts[1:])]
+
+
+def transcribe_segment(audio: np.ndarray, offset: float, core_start: Optional[float] = None,
+                       core_end: Optional[float] = None) -> List[dict]:
+    """Transcribe one segment and return its pieces on the recording's timeline.
+
+    Pieces whose midpoint falls outside [core_start, core_end) belong to a
+    neighbouring segment's core and are dropped, which removes the text the
+    overlap would otherwise duplicate.
+    """
+    if _model is None:
+        raise RuntimeError("Whisper model not available")
+    result = _model.transcribe(audio)
+    pieces = result.get("segments") or [{"start": 0.0, "end": len(audio) / SAMPLE_RATE, "text": result.get("text") or ""}]
+    out = []
+    for piece in pieces:
+        start = offset + float(piece["start"])
+        end = offset + float(piece["end"])
+        mid = (start + end) / 2
+        if core_start is not None and mid < core_start:
+            continue
+        if core_end is not None and mid >= core_end:
+            continue
+        text = (piece.get("text") or "").strip()
+        if text:
+            out.append({"start": round(start, 2), "end": round(end, 2), "text": text})
+    return out
+
+
+def prepare(src_path: str, pcm_path: str, max_seconds: Optional[float], long_seconds: float,
+            segment_seconds: float, overlap_seconds: float) -> Tuple[int, List[Tuple[int, int, int, int]]]:
+    """Decode ``src_path`` into ``pcm_path`` and plan the segments to transcribe."""
+    n = decode_to_pcm(src_path, pcm_path, max_seconds)
+    if n <= long_seconds * SAMPLE_RATE:
+        return n, [(0, n, 0, n)] if n else []
+    audio = np.memmap(pcm_path, dtype=np.float32, mode="r", shape=(n,))
+    return n, split_on_silence(audio, segment_seconds, overlap_seconds=overlap_seconds)
+
+
+def transcribe_pcm(pcm_path: str, n: int, start: int, stop: int, core_start: Optional[float] = None,
+                   core_end: Optional[float] = None) -> List[dict]:
+    """Transcribe samples [start, stop) of a decoded file; see transcribe_segment."""
+    audio = np.array(np.memmap(pcm_path, dtype=np.float32, mode="r", shape=(n,))[start:stop])
+    return transcribe_segment(audio, start / SAMPLE_RATE, core_start, core_end)